@@ -1,42 +1,79 @@
+""" Application factory. Importing the package only defines create_app: blueprints and extensions
+are imported when an app is built, the CLI commands when the flask command asks for them """
 import os
+
 from flask import Flask
+from flask.cli import AppGroup
 from flask_login import LoginManager
+
 from config import Config
-from .models import db, User
 
+login_manager = LoginManager()
+login_manager.login_view = "auth.login"
+login_manager.login_message_category = "error"
 
-app = Flask(__name__)
 
-# ensure the instance folder exists
-try:
-    os.makedirs(app.instance_path)
-except OSError:
-    pass
+class CommandGroup(AppGroup):
+    """ app.cli importing manage on first use, web workers never load the CLI's modules """
 
-app.config.from_object(Config)
-app.config.from_pyfile('../account.cfg')
+    def __init__(self, app):
+        super().__init__(app.name)
+        self.app = app
+        self.loaded = False
 
-db.init_app(app)
+    def load(self):
+        if not self.loaded:
+            import manage
+            manage.init_app(self.app)
+            self.loaded = True
 
-login_manager = LoginManager()
-login_manager.init_app(app)
+    def list_commands(self, ctx):
+        self.load()
+        return super().list_commands(ctx)
 
-import manage
-manage.init_app(app)
+    def get_command(self, ctx, name):
+        self.load()
+        return super().get_command(ctx, name)
 
-from . import auth
-app.register_blueprint(auth.auth_bp)
+def create_app(config=None):
+    """ Builds an app from Config with config (a mapping or an object) on top, e.g. a test app
+    with its own SQLALCHEMY_DATABASE_URI. Every app gets its own database engine and cache """
+    from .models import db
+    from .cache import cache
+    from .hashing import hasher
+    from .metrics import metrics
+    from . import analytics, auth, booking, feeds, mail
 
-from . import booking
-app.register_blueprint(booking.booking_bp)
-# app.add_url_rule('/', endpoint='home')
+    app = Flask(__name__)
+    app.cli = CommandGroup(app)
 
-from . import mail
-mail.mail.init_app(app)
+    app.config.from_object(Config)
+    app.config.from_pyfile('../account.cfg')
+    if isinstance(config, dict):
+        app.config.from_mapping(config)
+    elif config is not None:
+        app.config.from_object(config)
 
-login_manager.login_view = "auth.login"
-login_manager.login_message_category = "error"
+    # ensure the instance folder exists
+    os.makedirs(app.instance_path, exist_ok=True)
+
+    db.init_app(app)
+    login_manager.init_app(app)
+
+    app.register_blueprint(auth.auth_bp)
+    app.register_blueprint(booking.booking_bp)
+    app.register_blueprint(feeds.feeds_bp)
+    app.register_blueprint(analytics.analytics_bp)
+
+    mail.mail.init_app(app)
+    cache.init_app(app)
+    metrics.init_app(app)
+    metrics.add_gauge('vrra_mail_outbox_pending', 'Messages waiting in the outbox', mail.outbox_pending)
+    hasher.init_app(app)
+    metrics.add_gauge('vrra_password_hash_pending', 'Password hashes waiting for or running in a worker', hasher.queued)
+    return app
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.filter(User.id == int(user_id)).first()
\ No newline at end of file
+    from .users import user_cache
+    return user_cache.get(int(user_id))
@@ -0,0 +1,133 @@
+""" Room utilization reports (/analytics, flask usage-report) computed from the room_usage_daily
+rollup, never from reservations """
+import json
+from datetime import date, datetime, timedelta
+
+from flask import Blueprint, abort, current_app, jsonify, render_template, request
+from flask_login import current_user, login_required
+from sqlalchemy import select, type_coerce
+
+from config import OPEN_HOURS
+from .cache import cache
+from .models import db, Room, RoomUsageDaily
+from .rooms import get_sites, open_mask, search_rooms
+from .usage import USAGE_KEY
+
+analytics_bp = Blueprint('analytics', __name__)
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+
+def bits(masks):
+    """ n hour bitmasks -> n x 24 array of 0/1 """
+    import numpy as np
+    return (np.asarray(masks, dtype=np.int64)[:, None] >> np.arange(24)) & 1
+
+def ratio(part, whole):
+    import numpy as np
+    return np.divide(part, whole, out=np.zeros(np.shape(part)), where=np.asarray(whole) > 0)
+
+def usage_report(start, end, site=None, peaks=3):
+    """ Utilization between start and end (inclusive) of every room, or those of site: booked share
+    of open hours per room, per weekday x hour and per hour, and the peak hours. Rooms and rollup
+    rows are loaded once, everything else is array arithmetic """
+    import numpy as np
+    rooms = search_rooms(site).with_entities(Room.id, Room.name, Room.site, Room.capacity,
+        Room.open_hour, Room.close_hour).order_by(Room.id).all()
+    ids = np.array([r.id for r in rooms], dtype=np.int64)
+    capacity = np.array([r.capacity or 0 for r in rooms], dtype=np.int64)
+    open_bits = bits([open_mask(r) for r in rooms]).reshape(len(rooms), 24)
+
+    usage = RoomUsageDaily.__table__
+    # core rows, and dates left as the driver returns them for numpy to parse in one go
+    query = select(usage.c.room_id, type_coerce(usage.c.usage_date, db.String), usage.c.hours,
+        usage.c.meetings, usage.c.seat_hours).where(usage.c.usage_date >= start, usage.c.usage_date <= end)
+    if site:
+        query = query.where(usage.c.room_id.in_(ids.tolist()))
+    columns = list(zip(*db.session.connection().execute(query))) or [()] * 5
+    room_ids, hours, meetings, seats = (np.array(columns[i], dtype=np.int64) for i in (0, 2, 3, 4))
+    days = np.array(columns[1], dtype='datetime64[D]').astype(np.int64)
+
+    # rollup rows of rooms that no longer exist are left out
+    known = np.isin(room_ids, ids)
+    index = np.searchsorted(ids, room_ids[known])
+    booked = bits(hours[known]) & open_bits[index]
+    meetings, seats = meetings[known], seats[known]
+
+    # day 0 of datetime64 was a Thursday
+    weekdays = (days[known] + 3) % 7
+    period = np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 1).astype(np.int64)
+    days_per_weekday = np.bincount((period + 3) % 7, minlength=7)
+
+    booked_by_weekday = np.eye(7, dtype=np.int64)[weekdays].T @ booked
+    open_by_weekday = days_per_weekday[:, None] * open_bits.sum(axis=0)
+    heatmap = ratio(booked_by_weekday, open_by_weekday)
+    by_hour = ratio(booked_by_weekday.sum(axis=0), open_by_weekday.sum(axis=0))
+    by_weekday = ratio(booked_by_weekday.sum(axis=1), open_by_weekday.sum(axis=1))
+
+    room_booked = np.bincount(index, weights=booked.sum(axis=1), minlength=len(ids))
+    room_open = len(period) * open_bits.sum(axis=1)
+    room_meetings = np.bincount(index, weights=meetings, minlength=len(ids))
+    room_seats = np.bincount(index, weights=seats, minlength=len(ids))
+    utilization = ratio(room_booked, room_open)
+    seat_utilization = ratio(room_seats, room_open * capacity)
+
+    shown = slice(OPEN_HOURS[0], OPEN_HOURS[1])
+    top = [h for h in np.argsort(-by_hour, kind='stable')[:peaks] if by_hour[h] > 0]
+    return {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'site': site,
+        'days': len(period),
+        'utilization': round(float(ratio(room_booked.sum(), room_open.sum())), 4),
+        'meetings': int(room_meetings.sum()),
+        'hours': list(range(*OPEN_HOURS)),
+        'weekdays': WEEKDAYS,
+        'heatmap': np.round(heatmap[:, shown], 4).tolist(),
+        'by_hour': np.round(by_hour[shown], 4).tolist(),
+        'peak_hours': [{'hour': int(h), 'utilization': round(float(by_hour[h]), 4)} for h in top],
+        'busiest_weekday': WEEKDAYS[int(np.argmax(by_weekday))] if by_weekday.any() else None,
+        'rooms': sorted(({
+            'id': r.id,
+            'name': r.name,
+            'site': r.site,
+            'meetings': int(room_meetings[i]),
+            'booked_hours': int(room_booked[i]),
+            'open_hours': int(room_open[i]),
+            'utilization': round(float(utilization[i]), 4),
+            'seat_utilization': round(float(seat_utilization[i]), 4) if capacity[i] else None,
+            } for i, r in enumerate(rooms)), key=lambda r: -r['utilization']),
+        }
+
+def cached_report(start, end, site=None):
+    """ usage_report, served from the cache until a booking changes the rollup """
+    variant = f'{cache.current(USAGE_KEY)}:{start.isoformat()}:{end.isoformat()}:{site or ""}'
+    report = cache.get(USAGE_KEY, variant)
+    if report is None:
+        report = json.dumps(usage_report(start, end, site))
+        cache.set(USAGE_KEY, variant, report)
+    return json.loads(report)
+
+def report_range(start, end):
+    """ Parses YYYY-MM-DD bounds, the last ANALYTICS_DAYS up to today by default. Raises ValueError """
+    end = datetime.strptime(end, '%Y-%m-%d').date() if end else date.today()
+    start = datetime.strptime(start, '%Y-%m-%d').date() if start else end - timedelta(days=current_app.config['ANALYTICS_DAYS'] - 1)
+    if start > end or (end - start).days >= current_app.config['ANALYTICS_MAX_DAYS']:
+        raise ValueError(f'start must be on or before end, at most {current_app.config["ANALYTICS_MAX_DAYS"]} days apart')
+    return start, end
+
+@analytics_bp.route('/analytics')
+@login_required
+def analytics():
+    """ Utilization heatmap and per-room figures for admins, ?start=&end=&site=, ?format=json """
+    if not current_user.admin:
+        abort(403)
+    try:
+        start, end = report_range(request.args.get('start'), request.args.get('end'))
+    except ValueError:
+        abort(400)
+
+    report = cached_report(start, end, request.args.get('site') or None)
+    if request.args.get('format') == 'json':
+        return jsonify(report)
+    return render_template('analytics/report.html', report=report, sites=get_sites())
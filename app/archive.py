@@ -0,0 +1,60 @@
+""" Moves expired reservations out of the hot tables (flask archive-reservations) """
+from datetime import date, datetime, timedelta
+
+from sqlalchemy.orm import selectinload
+
+from .changes import prune_tombstones
+from .models import db, ArchivedReservation, Reservation, ReservationParticipant, RoomOccupancy
+
+
+def archive_expired(older_than=30, batch_size=500):
+    """ Moves reservations booked more than older_than days ago to the archive, one commit
+    per batch, yields the number moved per batch """
+    if older_than < 1:
+        # today's and upcoming reservations would lose their occupancy rows
+        raise ValueError(f'older_than must be at least 1 day, got {older_than}')
+    # anything dated before today is expired, so the date bound alone is enough
+    cutoff = date.today() - timedelta(days=older_than)
+    while True:
+        batch = db.session.query(Reservation).options(selectinload(Reservation.participants)).filter(
+            Reservation.booked_date < cutoff).order_by(Reservation.id).limit(batch_size).all()
+        if not batch:
+            break
+
+        archived_at = datetime.now()
+        db.session.add_all(ArchivedReservation(r, archived_at) for r in batch)
+        db.session.flush()
+
+        ids = [r.id for r in batch]
+        db.session.query(ReservationParticipant).filter(
+            ReservationParticipant.reservation_id.in_(ids)).delete(synchronize_session=False)
+        db.session.query(Reservation).filter(Reservation.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        # the deleted rows would otherwise stay in the identity map
+        db.session.expunge_all()
+        yield len(batch)
+
+    # room-days nobody can book anymore. their room_usage_daily rows stay, analytics outlive the reservations
+    db.session.query(RoomOccupancy).filter(RoomOccupancy.booked_date < cutoff).delete(synchronize_session=False)
+    # feeds synced before the pruned versions get a full feed instead
+    prune_tombstones(cutoff)
+    db.session.commit()
+
+def compact(full=False):
+    """ Returns free sqlite pages to the filesystem, gets the number of pages released or
+    None when the database can't be compacted incrementally (and full is not set) """
+    if db.engine.dialect.name != 'sqlite':
+        return None
+
+    db.session.remove()
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        pages = conn.exec_driver_sql('PRAGMA page_count').scalar()
+        if full:
+            # rewrites the file, also switches it to the auto_vacuum mode of SQLITE_PRAGMAS
+            conn.exec_driver_sql('VACUUM')
+        elif conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() == 2:
+            # pysqlite steps a single page per execute(), a script runs the pragma to completion
+            conn.connection.executescript('PRAGMA incremental_vacuum')
+        else:
+            return None
+        return pages - conn.exec_driver_sql('PRAGMA page_count').scalar()
@@ -2,18 +2,25 @@
 from flask import (
     Blueprint, flash, redirect, render_template, request, url_for
 )
+from werkzeug.exceptions import abort
 
-from werkzeug.security import check_password_hash, generate_password_hash
 from flask_login import login_user, login_required, logout_user, current_user
 from datetime import datetime
 
-from .models import User
-from .forms import RegisterForm,  LoginForm
+from .models import PendingNotification, User
+from .forms import RegisterForm,  LoginForm, NotificationForm
+from .hashing import HasherBusy, hasher
 from .models import db
 from .mail import send_msg
+from .users import invalidate_users
 
 auth_bp = Blueprint('auth', __name__, url_prefix='/auth')
 
+def busy(template, form):
+    """ Response for when too many password hashes are waiting """
+    flash('Too many people are signing in right now, please try again in a moment.', 'error')
+    return render_template(template, form=form), 503, {'Retry-After': '5'}
+
 @auth_bp.route('/register', methods=('GET', 'POST'))
 def register():
     """ Registers user to the system """
@@ -24,11 +31,16 @@ def register():
             (User.email==form.email.data)).first()
         
         if check_user is None:
+            try:
+                password = hasher.generate(form.password.data)
+            except HasherBusy:
+                return busy('auth/register.html', form)
+
             user = User(
                 form.username.data,
                 form.name.data,
                 form.email.data, 
-                generate_password_hash(form.password.data)
+                password
                 )
 
             mail_html = '<p>Welcome! Thanks for signing up. </p>'
@@ -37,6 +49,7 @@ def register():
                    
             db.session.add(user)
             db.session.commit()
+            invalidate_users()
 
             login_user(user)
             
@@ -53,7 +66,21 @@ def login():
     if form.validate_on_submit():
         user = User.query.filter(User.username==form.username.data).first()
 
-        if user and check_password_hash(user.password, form.password.data):
+        try:
+            valid = user is not None and hasher.check(user.password, form.password.data)
+        except HasherBusy:
+            return busy('auth/login.html', form)
+
+        if valid:
+            if hasher.needs_rehash(user.password):
+                # made with an older method or iteration count, upgraded while the password is at hand
+                try:
+                    user.password = hasher.generate(form.password.data)
+                    db.session.commit()
+                    invalidate_users()
+                except HasherBusy:
+                    # the next login upgrades it
+                    pass
             login_user(user)
             return redirect(url_for('booking.home'))
         else:
@@ -67,6 +94,27 @@ def logout():
     logout_user()
     return redirect(url_for('auth.login'))
 
+@auth_bp.route('/notifications', methods=('POST',))
+@login_required
+def notifications():
+    """ Switches the current user between a message per meeting change and a daily digest """
+    form = NotificationForm()
+    if not form.validate_on_submit():
+        abort(400)
+
+    db.session.query(User).filter(User.id==current_user.id).update(
+        {User.notify_digest: form.digest.data}, synchronize_session=False)
+    if not form.digest.data:
+        # changes held for the digest go out with the next flush
+        db.session.query(PendingNotification).filter(PendingNotification.username==current_user.username).update(
+            {PendingNotification.due_at: datetime.now()}, synchronize_session=False)
+    db.session.commit()
+    # current_user comes from the user cache
+    invalidate_users()
+
+    flash('You\'ll get a daily digest of meeting changes.' if form.digest.data else 'You\'ll get an email per meeting change.', 'success')
+    return redirect(url_for('booking.profile'))
+
 @auth_bp.route('/<int:id>/delete')
 @login_required
 def delete(id):
@@ -79,5 +127,6 @@ def delete(id):
     curr_user = db.session.query(User).filter(User.id == id).first()
     db.session.delete(curr_user)
     db.session.commit()
+    invalidate_users()
 
     return redirect(url_for('booking.home'))
@@ -1,19 +1,36 @@
 """ Handles reservation booking, editing, canceling and other booking utility functionalities """
-from operator import and_
+import base64
+import json
+import queue
+import zlib
 from flask import (
-    Blueprint, flash, redirect, render_template, request, url_for, jsonify
+    Blueprint, current_app, flash, redirect, render_template, request, url_for, jsonify
 )
 from werkzeug.exceptions import abort
-from datetime import datetime, time, date
+from sqlalchemy.orm import load_only
+from datetime import datetime, time, date, timedelta
 
 from flask_login import login_required, current_user
-from .forms import ReservationForm
-from .models import db, Reservation, User
-from config import NO_OF_ROOMS, OPEN_HOURS
-from .mail import send_msg
+from .forms import MAX_OCCURRENCES, CalendarFeedForm, NotificationForm, ReservationForm
+from .models import db, format_party, ArchivedParticipant, ArchivedReservation, Reservation, ReservationParticipant, Room, RoomOccupancy
+from config import OPEN_HOURS
+from .notify import notify
+from .cache import cache
+from .events import format_sse, publisher
+from .slots import find_slots
+from .users import get_directory
+from .pagination import keyset_page
+from .rooms import check_room, get_rooms, get_sites, open_mask, request_rooms, room_label
+from .changes import record_change
+from .occupancy import get_occupied, grid_ranges, hour_mask, occupancy_grid, claim, claim_days, release
+from .usage import add_usage, add_usage_days, invalidate_usage, remove_usage, seat_hours
 
 booking_bp = Blueprint('booking', __name__)
 
+# what listings show, the message and reminder state are left unloaded
+LISTING_COLUMNS = (Reservation.id, Reservation.username, Reservation.subject, Reservation.room_id, Reservation.booking_time,
+    Reservation.booked_date, Reservation.time_start, Reservation.time_end, Reservation._party)
+
 @booking_bp.route('/')
 def home():
     return render_template('booking/home.html')
@@ -21,34 +38,41 @@ def home():
 @booking_bp.route('/profile')
 @login_required
 def profile():
-    """ View user profile (reservation history) """
-    update_records()
-    send_reminder()
-
-    records = {}
-    reservations = db.session.query(Reservation).all()
-
-    for r in reservations:
-        if r.username == current_user.username:
-            records.setdefault('own', []).append(r)
-        elif str(f'{current_user.username}, {current_user.name}') in r.party:
-            records.setdefault('partied', []).append(r)
-
-    return render_template('booking/profile.html', records=records)
+    """ View user profile (reservation history), newest first. ?history=1 lists archived meetings """
+    history = request.args.get('history') == '1'
+    if history:
+        query = db.session.query(ArchivedReservation).join(
+            ArchivedParticipant, ArchivedParticipant.archive_id==ArchivedReservation.archive_id).filter(
+            ArchivedParticipant.username==current_user.username)
+        keys = (ArchivedParticipant.booked_date, ArchivedReservation.time_start, ArchivedReservation.archive_id)
+        records, next_cursor, filters = list_page(query, keys, ArchivedReservation.room_id, desc=True)
+    else:
+        # the host is a participant too, so one join covers own and partied reservations
+        query = db.session.query(Reservation).options(load_only(*LISTING_COLUMNS)).join(
+            ReservationParticipant, ReservationParticipant.reservation_id==Reservation.id).filter(
+            ReservationParticipant.username==current_user.username)
+        keys = (ReservationParticipant.booked_date, Reservation.time_start, Reservation.id)
+        records, next_cursor, filters = list_page(query, keys, Reservation.room_id, desc=True)
+
+    if request.args.get('format') == 'json':
+        return jsonify({'records': [listing_record(r) for r in records], 'next': next_cursor})
+    return render_template('booking/profile.html', records=records, next_cursor=next_cursor, filters=filters,
+        history=history, feed_form=CalendarFeedForm(), notify_form=NotificationForm(digest=current_user.notify_digest))
 
 @booking_bp.route('/index')
 @login_required
 def index():
     """ Displays ongoing reservations """
-    update_records()
-    send_reminder()
-
-    if current_user.is_authenticated and current_user.admin:
-        reservations = db.session.query(Reservation).all()
-    else:
-        reservations = db.session.query(Reservation).filter(Reservation.status==0).all()
+    query = db.session.query(Reservation).options(load_only(*LISTING_COLUMNS))
+    if not current_user.admin:
+        # the date bound lets the index skip past reservations before status is computed
+        query = query.filter(Reservation.booked_date>=date.today(), Reservation.status==0)
+    keys = (Reservation.booked_date, Reservation.time_start, Reservation.id)
+    records, next_cursor, filters = list_page(query, keys, Reservation.room_id)
 
-    return render_template('booking/index.html', records=reservations)
+    if request.args.get('format') == 'json':
+        return jsonify({'records': [listing_record(r) for r in records], 'next': next_cursor})
+    return render_template('booking/index.html', records=records, next_cursor=next_cursor, filters=filters)
 
 @booking_bp.route('/book', methods=('GET', 'POST'))
 @login_required
@@ -56,14 +80,16 @@ def book():
     form = ReservationForm()
 
     # get party list to be listed out as choices, exclude current_user
-    party_list = [p for p in get_party() if (p[0] != current_user.username)]
+    directory = get_directory()
+    party_list = [p for p in directory.party if (p[0] != current_user.username)]
     form.party.choices = [(p[0], p[1]) for p in party_list]
+    rooms = room_choices(form, form.room_id.data)
 
     if request.method == 'POST' and form.validate_on_submit():
         party_list_form = []
 
         for party in form.party.data:
-            party_list_form.append(party_list[[p[0] for p in party_list].index(party)])
+            party_list_form.append(directory.index[party])
 
         # include current_user back in reservation
         party_list_form.append((current_user.username, current_user.name))
@@ -77,6 +103,11 @@ def book():
         time_start = time(int(form.time_start.data),0,0,0)
         time_end = time(int(form.time_end.data) if int(form.time_end.data)!=24 else 0,0,0,0)
 
+        if form.repeat.data != 'none':
+            if book_series(form, party_list_form, time_start, time_end):
+                return redirect(url_for('booking.index'))
+            return render_template('booking/book.html', form=form, party=party_list, hours=OPEN_HOURS, **rooms)
+
         reservation = Reservation(
                 current_user.username,
                 form.subject.data,  
@@ -91,16 +122,27 @@ def book():
                 )
 
         error = check_room_avail(int(form.room_id.data), form.booked_date.data, time_start, time_end)
-        error = check_party_avail(form.booked_date.data, time_start, time_end, party_list_form)
+        if error == '':
+            error = check_party_avail(form.booked_date.data, time_start, time_end, party_list_form)
+
+        # the check above is advisory, the claim is what stops concurrent double bookings
+        if error == '' and not claim(int(form.room_id.data), form.booked_date.data, hour_mask(time_start, time_end)):
+            db.session.rollback()
+            error = f'Room {form.room_id.data} is unavailable on {form.booked_date.data} at {time_start} - {time_end}'
 
         if error == '':
             db.session.add(reservation)
+            db.session.flush()
+            mask = hour_mask(time_start, time_end)
+            add_usage(int(form.room_id.data), form.booked_date.data, mask, seat_hours(mask, len(party_list_form)))
+            record_change([reservation.id], [p[0] for p in party_list_form])
             db.session.commit()
+            publish_status(booked=[(form.room_id.data, form.booked_date.data, time_start, time_end)])
 
             party_list_form.remove((current_user.username, current_user.name))
-            emails = get_party_email(p[0] for p in party_list_form)
 
             info = {
+                'subject':form.subject.data,
                 'date':form.booked_date.data,
                 'time_start':form.time_start.data,
                 'time_end':form.time_end.data,
@@ -110,12 +152,13 @@ def book():
                 'message': form.message.data
                 }
 
-            if party_list_form:
-                party_msg_html = render_template('mail.html', message='You\'ve been invited to a meeting.', info=info)
-                send_msg(f'[VRRA] Meeting Invitation on {info["date"]} at {info["time_start"]}:00 - {info["time_end"]}:00', emails, party_msg_html)
-
-            user_msg_html = render_template('mail.html', message = 'You\'ve made a room reservation.', info=info)
-            send_msg(f'[VRRA] You\'ve reserved a meeting room on {info["date"]} at {info["time_start"]}:00 - {info["time_end"]}:00', [current_user.email], user_msg_html)
+            notify([p[0] for p in party_list_form], 'invited',
+                f'[VRRA] Meeting Invitation on {info["date"]} at {info["time_start"]}:00 - {info["time_end"]}:00',
+                'You\'ve been invited to a meeting.', info, reservation.id)
+            notify([current_user.username], 'invited',
+                f'[VRRA] You\'ve reserved a meeting room on {info["date"]} at {info["time_start"]}:00 - {info["time_end"]}:00',
+                'You\'ve made a room reservation.', info, reservation.id)
+            db.session.commit()
             
             return redirect(url_for('booking.index'))
     
@@ -126,7 +169,94 @@ def book():
         form.time_end.default = datetime.now().hour + 1
         form.process()
     
-    return render_template('booking/book.html', form=form, party=party_list, hours=OPEN_HOURS, no_of_rooms=NO_OF_ROOMS)
+    return render_template('booking/book.html', form=form, party=party_list, hours=OPEN_HOURS, **rooms)
+
+def room_choices(form, selected=None):
+    """ Fills the room choices of a reservation form with the page of rooms the request's filter
+    selects, plus the selected room. Gets the template arguments of the room filter """
+    rooms, next_after, filters = request_rooms()
+    if selected is not None and selected not in {r.id for r in rooms}:
+        rooms += db.session.query(Room).filter(Room.id==selected).all()
+    form.room_id.choices = [(r.id, room_label(r)) for r in rooms]
+    more_rooms = url_for(request.endpoint, after=next_after, **request.view_args, **filters) if next_after else None
+    return {'more_rooms': more_rooms, 'room_filters': filters, 'sites': get_sites()}
+
+def book_series(form, party_list, time_start, time_end):
+    """ Books every free occurrence of a recurring reservation in one transaction, returns booked dates """
+    room_id = int(form.room_id.data)
+    error = check_room(room_id, time_start, time_end)
+    if error:
+        flash(error, 'error')
+        return []
+    dates = expand_recurrence(form.booked_date.data, form.repeat.data, form.interval.data or 1, form.until.data, form.count.data)
+    if not dates:
+        flash('The series has no occurrences.', 'error')
+        return []
+
+    conflicts = check_series(room_id, dates, time_start, time_end, party_list)
+    mask = hour_mask(time_start, time_end)
+    claimed = set(claim_days(room_id, [d for d in dates if d not in conflicts], mask))
+    for d in dates:
+        if d not in conflicts and d not in claimed:
+            conflicts[d] = f'Room {room_id} is unavailable at {time_start} - {time_end}'
+
+    for d in dates:
+        if d in conflicts:
+            flash(f'{d}: {conflicts[d]}', 'error')
+
+    booked = [d for d in dates if d not in conflicts]
+    if not booked:
+        return booked
+
+    # core executemany inserts, the claims above hold sqlite's write lock for insert_all
+    now = datetime.now()
+    rows = [{
+        'username': current_user.username,
+        'subject': form.subject.data,
+        'room_id': room_id,
+        'booking_time': now,
+        'booked_date': d,
+        'time_start': time_start,
+        'time_end': time_end,
+        '_party': format_party(party_list),
+        'message': form.message.data,
+        # same-day meetings get no reminder
+        'reminder': d == date.today(),
+        'updated_at': now,
+        'status': 0,
+        } for d in booked]
+    db.insert_all(Reservation.__table__, rows)
+    db.session.execute(ReservationParticipant.__table__.insert(), [
+        {'reservation_id': row['id'], 'username': p[0], 'booked_date': row['booked_date']}
+        for row in rows for p in party_list])
+    add_usage_days(room_id, booked, mask, seat_hours(mask, len(party_list)))
+    record_change([row['id'] for row in rows], [p[0] for p in party_list])
+    db.session.commit()
+    publish_status(booked=[(room_id, d, time_start, time_end) for d in booked])
+
+    flash(f'Booked {len(booked)} of {len(dates)} occurrences.', 'success')
+
+    # one summary email for the whole series
+    party = [p for p in party_list if p[0] != current_user.username]
+    info = {
+        'subject': form.subject.data,
+        'date': f'{booked[0]} - {booked[-1]}',
+        'occurrences': booked,
+        'time_start': form.time_start.data,
+        'time_end': form.time_end.data,
+        'party': party,
+        'booking_time': now.strftime('%H:%M:%S'),
+        'host': (current_user.name, current_user.username),
+        'message': form.message.data
+        }
+
+    notify([p[0] for p in party], 'invited',
+        f'[VRRA] Meeting Invitation: {len(booked)} meetings from {booked[0]} at {info["time_start"]}:00 - {info["time_end"]}:00',
+        'You\'ve been invited to a recurring meeting.', info)
+    notify([current_user.username], 'invited', f'[VRRA] You\'ve reserved a meeting room {len(booked)} times from {booked[0]}',
+        'You\'ve made a recurring room reservation.', info)
+    db.session.commit()
+    return booked
 
 @booking_bp.route('/<int:id>/edit', methods=('GET', 'POST'))
 @login_required
@@ -136,9 +266,12 @@ def edit(id):
     form = ReservationForm()
 
     # Exclude current_user from choices
-    party_list = [p for p in get_party() if (p[0] != current_user.username)]
+    directory = get_directory()
+    party_list = [p for p in directory.party if (p[0] != current_user.username)]
     form.party.choices = [(p[0], p[1]) for p in party_list]
     
+    rooms = room_choices(form, form.room_id.data if request.method == 'POST' else prev_record.room_id)
+
     prev_party = [p.split(',')[0] for p in prev_record.party]
     set_prev = set(prev_party)
     ts = prev_record.time_start.strftime('%H')
@@ -146,21 +279,30 @@ def edit(id):
     if request.method == 'POST' and form.is_submitted():
         party_list_form = []
 
-        # Indexes of party
-        party_index = [p[0] for p in party_list]
-        
         for party in form.party.data:
-            party_list_form.append(party_list[party_index.index(party)])
+            if party in directory.index and party != current_user.username:
+                party_list_form.append(directory.index[party])
 
         # include current_user in meeting
         party_list_form.append((current_user.username, current_user.name))
 
         # parse time object from given hour integer
         time_start = time(int(form.time_start.data),0,0,0)
-        time_end = time(int(form.time_end.data),0,0,0)
+        time_end = time(int(form.time_end.data) if int(form.time_end.data)!=24 else 0,0,0,0)
+
+        error = check_room_avail(int(form.room_id.data), form.booked_date.data,  time_start, time_end, id)
+        if error == '':
+            error = check_party_avail(form.booked_date.data, time_start, time_end, party_list_form, id)
+
+        if error == '':
+            prev_slot = (prev_record.room_id, prev_record.booked_date, prev_record.time_start, prev_record.time_end)
 
-        error = check_room_avail(form.room_id.data, form.booked_date.data,  time_start, time_end, id)
-        error = check_party_avail(form.booked_date.data, time_start, time_end, party_list_form, id)
+            # move the reservation's hours in the occupancy index, the claim fails if
+            # someone else took the room since the check above
+            release(prev_record.room_id, prev_record.booked_date, hour_mask(prev_record.time_start, prev_record.time_end))
+            if not claim(int(form.room_id.data), form.booked_date.data, hour_mask(time_start, time_end)):
+                db.session.rollback()
+                error = f'Room {form.room_id.data} is unavailable on {form.booked_date.data} at {time_start} - {time_end}'
 
         if error == '':
             # Notify party about changes made to this reservation
@@ -191,26 +333,15 @@ def edit(id):
                         'message':      prev_record.message
                 }
 
-            print(party_disinvited)
-            print(party_added)
-            print(party_unchanged)
-
-
-            if party_disinvited:
-                disinvite_html = render_template('mail.html', message= 'You\'ve been disinvited from a meeting.', info=prev_info)
-                send_msg(f'[VRRA] Meeting Disinvitation: <{prev_info["subject"]}> .', get_party_email(party_disinvited), disinvite_html)
-
-            if party_added:
-                invite_html = render_template('mail.html', message='You\'ve been invited to a meeting.', info=info)
-                send_msg(f'[VRRA] Meeting Invitation on {info["date"]} at {info["time_start"]}:00 - {info["time_end"]}:00', get_party_email(party_added), invite_html)
-
-            if party_unchanged:
-                modified_html = render_template('mail.html', message=f'The [{prev_info["subject"]}](previous) meeting has been modified.', info=info)
-                send_msg(f'[VRRA] Meeting Modified: <{prev_info["subject"]}>', get_party_email(party_unchanged), modified_html)
-
-            # Email to host
-            user_msg_html = render_template('mail.html', message=f'The [{prev_info["subject"]}] has been modified.', info=info)
-            send_msg(f'[VRRA] You\'ve modified a reservation', [current_user.email], user_msg_html)
+            # held and merged with further changes before anyone is emailed
+            notify(party_disinvited, 'removed', f'[VRRA] Meeting Disinvitation: <{prev_info["subject"]}> .',
+                'You\'ve been disinvited from a meeting.', prev_info, id)
+            notify(party_added, 'invited', f'[VRRA] Meeting Invitation on {info["date"]} at {info["time_start"]}:00 - {info["time_end"]}:00',
+                'You\'ve been invited to a meeting.', info, id)
+            notify(party_unchanged, 'modified', f'[VRRA] Meeting Modified: <{prev_info["subject"]}>',
+                f'The [{prev_info["subject"]}](previous) meeting has been modified.', info, id)
+            notify([current_user.username], 'modified', f'[VRRA] You\'ve modified a reservation',
+                f'The [{prev_info["subject"]}] has been modified.', info, id)
 
             db.session.query(Reservation).filter(Reservation.id==id).update(
                 dict(
@@ -219,9 +350,20 @@ def edit(id):
                     booked_date=form.booked_date.data,
                     time_start=time_start,
                     time_end=time_end, 
+                    # a new date needs a new reminder
+                    reminder=prev_record.reminder if form.booked_date.data == prev_record.booked_date else form.booked_date.data == date.today(),
+                    updated_at=datetime.now(),
                     _party= ';'.join(f'{name}'.replace("'", "").strip("() ") for name in party_list_form)
                     ))
+            set_participants(id, form.booked_date.data, [p[0] for p in party_list_form])
+            usernames = [p[0] for p in party_list_form]
+            # prev_record already shows the update
+            prev_mask, mask = hour_mask(prev_slot[2], prev_slot[3]), hour_mask(time_start, time_end)
+            remove_usage(prev_slot[0], prev_slot[1], prev_mask, seat_hours(prev_mask, len(set_prev)))
+            add_usage(int(form.room_id.data), form.booked_date.data, mask, seat_hours(mask, len(usernames)))
+            record_change([id], usernames, removed=[(id, u) for u in set_prev - set(usernames)])
             db.session.commit()
+            publish_status(freed=[prev_slot], booked=[(form.room_id.data, form.booked_date.data, time_start, time_end)])
 
             return redirect(url_for('booking.index'))
         else:
@@ -233,7 +375,7 @@ def edit(id):
         form.process()
         form.party.data = prev_party
 
-    return render_template('booking/edit.html', record=prev_record, form=form, party=party_list, no_of_rooms=NO_OF_ROOMS, hours=OPEN_HOURS, te=te, ts=ts)
+    return render_template('booking/edit.html', record=prev_record, form=form, party=party_list, hours=OPEN_HOURS, te=te, ts=ts, **rooms)
 
 @booking_bp.route('/<int:id>/cancel', methods= ('POST','GET'))
 @login_required
@@ -241,8 +383,7 @@ def cancel(id):
     """ Cancels reservation<id> """
     r = db.session.query(Reservation).filter(Reservation.id==id).first()
 
-    party_emails = get_party_email([p.split(',')[0] for p in r.party])
-    party_emails.append(current_user.email)
+    usernames = [u for u, in db.session.query(ReservationParticipant.username).filter(ReservationParticipant.reservation_id==id)]
 
     info = {
         'subject': r.subject,
@@ -254,158 +395,329 @@ def cancel(id):
         'host': (current_user.name, current_user.username)
         }
 
-    cancel_html = render_template('mail.html', message=f'The meeting you\'re in has been canceled.', info=info)
-    send_msg(f'[VRRA] Meeting Canceled: <{info["subject"]}>', party_emails, cancel_html)
+    notify(set(usernames) | {current_user.username}, 'cancelled', f'[VRRA] Meeting Canceled: <{info["subject"]}>',
+        f'The meeting you\'re in has been canceled.', info, id)
 
+    slot = (r.room_id, r.booked_date, r.time_start, r.time_end)
+    record_change([], [], removed=[(id, u) for u in usernames])
+    mask = hour_mask(r.time_start, r.time_end)
+    release(r.room_id, r.booked_date, mask)
+    remove_usage(r.room_id, r.booked_date, mask, seat_hours(mask, len(usernames)))
+    db.session.query(ReservationParticipant).filter(ReservationParticipant.reservation_id==id).delete()
     db.session.query(Reservation).filter(Reservation.id==id).delete()
     db.session.commit()
+    publish_status(freed=[slot])
 
     return redirect(url_for('booking.index'))
 
 # Route used for updatinng schedule table
 @booking_bp.route('/_get_status')
 def get_status():
-    date = request.args.get('date', datetime.today().strftime('%Y-%m-%d'))
-    record = get_booked(date)
-    return jsonify(record)
-
-def get_booked(date):
-    """ Gets all reserved time on given date. Utility for status table"""
+    try:
+        date = datetime.strptime(request.args.get('date', datetime.today().strftime('%Y-%m-%d')), '%Y-%m-%d').date()
+    except ValueError:
+        abort(400)
+    rooms = requested_rooms()
+
+    # book/edit/cancel bump the date's version, polling clients revalidate without touching the db
+    key = f'status:{date.isoformat()}'
+    version, modified = cache.version(key)
+    # one body per page of rooms
+    variant = f'{version}:{",".join(map(str, rooms))}'
+    etag = f'{date.isoformat()}-{version}-{zlib.crc32(variant.encode()):x}'
+
+    if etag in request.if_none_match \
+        or (not request.if_none_match and request.if_modified_since and request.if_modified_since >= modified):
+        response = current_app.response_class(status=304)
+    else:
+        body = cache.get(key, variant)
+        if body is None:
+            body = json.dumps(get_booked(date, rooms))
+            cache.set(key, variant, body)
+        response = current_app.response_class(body, mimetype='application/json')
+
+    response.set_etag(etag)
+    response.last_modified = modified
+    response.cache_control.no_cache = True
+    return response
+
+def get_booked(date, rooms):
+    """ Gets reserved time of given rooms on given date. Utility for status table"""
     booked = {}
-    for i in range(1,NO_OF_ROOMS+1):
+    for i in rooms:
         booked[i] = []
-    for r in db.session.query(Reservation.room_id, Reservation.time_start, Reservation.time_end).filter(Reservation.booked_date==date).all():
-        booked[r.room_id].append(
-            (int(r.time_start.strftime('%H')), int(r.time_end.strftime('%H')))
-        )
+    for r in db.session.query(Reservation.room_id, Reservation.time_start, Reservation.time_end).filter(
+            Reservation.booked_date==date, Reservation.room_id.in_(rooms)).all():
+        booked[r.room_id].append((r.time_start.hour, r.time_end.hour))
     return booked
 
+def requested_rooms():
+    """ Room ids of the rooms argument (comma separated), without it of the page of rooms
+    the filter arguments select """
+    if not request.args.get('rooms'):
+        return [r.id for r in request_rooms()[0]]
+    try:
+        rooms = sorted({int(r) for r in request.args['rooms'].split(',') if r})
+    except ValueError:
+        abort(400)
+    if len(rooms) > current_app.config['PAGE_SIZE_MAX']:
+        abort(400)
+    return rooms
+
+@booking_bp.route('/_get_status_range')
+def get_status_range():
+    """ Occupancy of several rooms over several days, as bitsets or hour ranges """
+    try:
+        start = datetime.strptime(request.args.get('start', datetime.today().strftime('%Y-%m-%d')), '%Y-%m-%d').date()
+        end = datetime.strptime(request.args.get('end', start.isoformat()), '%Y-%m-%d').date()
+    except ValueError:
+        abort(400)
+    rooms = requested_rooms()
+
+    encoding = request.args.get('encoding', 'bitset')
+    if end < start or (end - start).days >= current_app.config['STATUS_RANGE_MAX_DAYS'] \
+        or encoding not in ('bitset', 'ranges') or len(get_rooms(rooms)) != len(rooms):
+        abort(400)
+
+    grid = occupancy_grid(start, end, rooms)
+    record = {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'hours': OPEN_HOURS,
+        'rooms': rooms,
+        'encoding': encoding
+        }
+
+    if encoding == 'bitset':
+        import numpy as np
+        # per room: days x hours bits, row-major, most significant bit first
+        record['grid'] = {r: base64.b64encode(np.packbits(grid[i]).tobytes()).decode() for i, r in enumerate(rooms)}
+    else:
+        # per room and date: [start hour, end hour) ranges
+        ranges = {}
+        for room, day, first, last in grid_ranges(grid).tolist():
+            date = (start + timedelta(days=day)).isoformat()
+            ranges.setdefault(rooms[room], {}).setdefault(date, []).append((first + OPEN_HOURS[0], last + OPEN_HOURS[0]))
+        record['grid'] = ranges
+
+    return jsonify(record)
+
+@booking_bp.route('/_find_slots')
+@login_required
+def find_free_slots():
+    """ Earliest slots where the current user, given party and a room are all free """
+    try:
+        duration = int(request.args.get('duration', 1))
+        start = datetime.strptime(request.args.get('start') or datetime.today().strftime('%Y-%m-%d'), '%Y-%m-%d').date()
+        end = datetime.strptime(request.args.get('end') or (start + timedelta(days=6)).isoformat(), '%Y-%m-%d').date()
+        k = int(request.args.get('k', 5))
+        exclude = int(request.args['exclude']) if request.args.get('exclude') else None
+    except ValueError:
+        abort(400)
+
+    if duration < 1 or duration > OPEN_HOURS[1] - OPEN_HOURS[0] or end < start \
+        or (end - start).days >= current_app.config['STATUS_RANGE_MAX_DAYS'] or k < 1 or k > 50:
+        abort(400)
+
+    party = set(request.args.getlist('party')) | {current_user.username}
+    # the rooms of the form's room filter, one page of them
+    rooms = request_rooms()[0]
+    slots = find_slots(party, duration, start, end, [r.id for r in rooms], k, exclude,
+        open_masks={r.id: open_mask(r) for r in rooms})
+
+    return jsonify({'slots': [
+        {'date': d.isoformat(), 'time_start': h, 'time_end': h + duration, 'room': room_id} for d, h, room_id in slots
+        ]})
+
+def publish_status(freed=(), booked=()):
+    """ Invalidates cached status tables and pushes per-date deltas, called after commits.
+    freed and booked hold (room_id, booked_date, time_start, time_end) tuples """
+    deltas = {}
+    for changes, is_booked in ((freed, False), (booked, True)):
+        for room_id, booked_date, time_start, time_end in changes:
+            deltas.setdefault(booked_date, []).append({
+                'room': int(room_id),
+                'start': time_start.hour,
+                'end': time_end.hour if time_end.hour != 0 else 24,
+                'booked': is_booked
+                })
+
+    for booked_date, changes in deltas.items():
+        cache.bump(f'status:{booked_date.isoformat()}')
+        publisher.publish({'date': booked_date.isoformat(), 'changes': changes})
+    if deltas:
+        # every change that reaches here went through the usage rollup too
+        invalidate_usage()
+
+@booking_bp.route('/status/stream')
+def status_stream():
+    """ Pushes room status deltas, optionally only for one date """
+    date = request.args.get('date')
+    q = publisher.subscribe()
+
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    event = q.get(timeout=15)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+
+                if event is None:
+                    yield format_sse({}, event='resync')
+                    return
+                if date is None or event['date'] == date:
+                    yield format_sse(event)
+        finally:
+            publisher.unsubscribe(q)
+
+    return current_app.response_class(stream(), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @booking_bp.route('/status', methods=('GET','POST'))
 def status():
-    """ Displays all room status """
-    update_records()
-    send_reminder()
-    return render_template('booking/status.html', hours=OPEN_HOURS, no_of_rooms=NO_OF_ROOMS)
+    """ Displays status of the page of rooms the site, capacity and equipment filter selects """
+    rooms, next_after, room_filters = request_rooms()
+    closed = {r.id: [h for h in range(*OPEN_HOURS) if not open_mask(r) >> h & 1] for r in rooms}
+    return render_template('booking/status.html', hours=OPEN_HOURS, rooms=rooms, closed=closed, next_after=next_after,
+        room_filters=room_filters, sites=get_sites(), labels={r.id: room_label(r) for r in rooms})
 
 # Functions to get data from DB
 def get_party():
     """ Gets all participants/users in the system, excluding admin """
-    party = db.session.query(User.username, User.name).filter(User.admin!=True).all()
-    return party
+    return get_directory().party
 
 def check_room_avail(room_id, booked_date, time_start,time_end, edit_id=None):
-    """ Checks room availability """
-    if db.session.query(Reservation).first():
-        if edit_id != None:
-            records = db.session.query(Reservation).filter(Reservation.id!=edit_id, Reservation.booked_date==booked_date).all()
-        else:
-            records = db.session.query(Reservation).filter(Reservation.booked_date==booked_date).all()
-
-        time_end = time_end if time_end!=0 else 24
-
-        for rec in records:
-            # print(rec.room_id, room_id, '\n', rec.time_start,  rec.time_end, '\n', time_start, time_end)
-            if rec.room_id == room_id \
-                and (rec.time_start <= time_start and time_start <= rec.time_end) \
-                and (rec.time_start <= time_end and time_end <= rec.time_end):
-                return f'Room {room_id} is unavailable on {booked_date} at {time_start} - {time_end}'
+    """ Checks room availability against the room's opening hours and the occupancy index """
+    error = check_room(room_id, time_start, time_end)
+    if error:
+        return error
+    occupied = get_occupied(room_id, booked_date)
+
+    if edit_id != None:
+        # hours held by the reservation being edited don't count as taken
+        prev = db.session.query(Reservation.room_id, Reservation.booked_date, Reservation.time_start, Reservation.time_end).filter(Reservation.id==edit_id).first()
+        if prev and prev.room_id == room_id and prev.booked_date == booked_date:
+            occupied &= ~hour_mask(prev.time_start, prev.time_end)
+
+    if occupied & hour_mask(time_start, time_end):
+        return f'Room {room_id} is unavailable on {booked_date} at {time_start} - {time_end}'
     return ''
 
 def check_party_avail(booked_date, time_start, time_end, party_list, id=None):
     """ Checks all participants availability """
-    if db.session.query(Reservation).first():
-        if id:
-            records = db.session.query(Reservation._party, Reservation.time_start, Reservation.time_end).filter(Reservation.booked_date==booked_date, Reservation.id!=id).all()
-        else:
-            records = db.session.query(Reservation._party, Reservation.time_start, Reservation.time_end).filter(Reservation.booked_date==booked_date).all()
-
-        time_end = time_end if time_end!=0 else 24
-
-        for rec in records:
-            for party in party_list:
-                if (party[0] in rec._party) \
-                    and (rec.time_start <= time_start and time_start <= rec.time_end) \
-                    and (rec.time_start <= time_end and time_end <= rec.time_end):
-                    
-                    if party[0] is current_user.username:
-                        return f'{current_user.name}(current) is unavailable on {booked_date} at {time_start} - {time_end}'
-                    return f'{party[1]}({party[0]}) is unavailable on {booked_date} at {time_start} - {time_end}'
+    query = db.session.query(ReservationParticipant.username, Reservation.time_start, Reservation.time_end).join(
+        Reservation, Reservation.id==ReservationParticipant.reservation_id).filter(
+        ReservationParticipant.username.in_([p[0] for p in party_list]),
+        ReservationParticipant.booked_date==booked_date)
+    if id:
+        query = query.filter(ReservationParticipant.reservation_id!=id)
+
+    names = {p[0]: p[1] for p in party_list}
+    mask = hour_mask(time_start, time_end)
+
+    for rec in query.all():
+        if hour_mask(rec.time_start, rec.time_end) & mask:
+            if rec.username == current_user.username:
+                return f'{current_user.name}(current) is unavailable on {booked_date} at {time_start} - {time_end}'
+            return f'{names[rec.username]}({rec.username}) is unavailable on {booked_date} at {time_start} - {time_end}'
     return ''
 
-def get_party_email(party_usernames):
-    """ Get given participants' emails"""
-    emails = db.session.query(User.username, User.email).filter(User.username.in_(party_usernames)).all()
-    return emails
-        
-def check_time_passed(date, ts, te):
-    """ Compares given datetime with current datetime """
-    d1 = str(date).split('-')
-    d2 = datetime.today().strftime('%Y-%m-%d').split('-')
-    d1 = [int(i)for i in d1]
-    d2 = [int(i)for i in d2]
-
-    check = [i <= j for i, j in zip(d1, d2)]
-    for c in check:
-        if c is False:
-            return 0
-
-     # 0: coming soon; 1: ongoing; 2: expired
-    if d1[2] == d2[2]:        
-        hour_now = int(datetime.now().strftime('%H'))
-        time_end = int(te.strftime('%H'))
-        time_end = time_end if time_end != 0 else 24
-        time_start = int(ts.strftime('%H'))
-        if(time_end > hour_now):
-            if(hour_now >= time_start):
-                return 1
-            return 0
-    return 2
-
-def check_time_diff(date):
-    """ Calculates time difference between given date and today"""
-    d1 = str(date).split('-')
-    d1 = datetime(int(d1[0]), int(d1[1]), int(d1[2]))
-    d2 = datetime.today()    
-    return (d1-d2).days
+def expand_recurrence(first, repeat, interval=1, until=None, count=None):
+    """ Gets the dates of a daily or weekly series, ending at until or after count occurrences,
+    never more than MAX_OCCURRENCES. A series with neither has no dates """
+    if repeat == 'none':
+        return [first]
+    if until is None and not count:
+        return []
+
+    step = timedelta(days=interval) if repeat == 'daily' else timedelta(weeks=interval)
+    count = min(count or MAX_OCCURRENCES, MAX_OCCURRENCES)
+
+    dates = []
+    d = first
+    while len(dates) < count and (until is None or d <= until):
+        dates.append(d)
+        d += step
+    return dates
+
+def check_series(room_id, dates, time_start, time_end, party_list):
+    """ Checks room and participants for every date with one range query each, returns {date: error} """
+    mask = hour_mask(time_start, time_end)
+    conflicts = {}
+
+    for o in db.session.query(RoomOccupancy.booked_date, RoomOccupancy.hours).filter(
+            RoomOccupancy.room_id==room_id,
+            RoomOccupancy.booked_date >= dates[0], RoomOccupancy.booked_date <= dates[-1]).all():
+        if o.hours & mask:
+            conflicts[o.booked_date] = f'Room {room_id} is unavailable at {time_start} - {time_end}'
+
+    names = {p[0]: p[1] for p in party_list}
+    for rec in db.session.query(ReservationParticipant.username, ReservationParticipant.booked_date,
+            Reservation.time_start, Reservation.time_end).join(
+            Reservation, Reservation.id==ReservationParticipant.reservation_id).filter(
+            ReservationParticipant.username.in_(names),
+            ReservationParticipant.booked_date >= dates[0], ReservationParticipant.booked_date <= dates[-1]).all():
+        if rec.booked_date not in conflicts and hour_mask(rec.time_start, rec.time_end) & mask:
+            conflicts[rec.booked_date] = f'{names[rec.username]}({rec.username}) is unavailable at {time_start} - {time_end}'
+
+    # the range also covers dates in between occurrences
+    return {d: e for d, e in conflicts.items() if d in dates}
+
+def set_participants(reservation_id, booked_date, usernames):
+    """ Replaces participant rows of a reservation, caller commits """
+    db.session.query(ReservationParticipant).filter(ReservationParticipant.reservation_id==reservation_id).delete()
+    db.session.add_all(ReservationParticipant(u, booked_date, reservation_id) for u in usernames)
+
+def list_page(query, keys, room_id, desc=False):
+    """ Applies the start, end and room filters of the request to a listing and gets
+    (records, next cursor, filters) of the page after the cursor argument """
+    try:
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d').date() if request.args.get('start') else None
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if request.args.get('end') else None
+        room = int(request.args['room']) if request.args.get('room') else None
+        per_page = int(request.args.get('per_page', current_app.config['PAGE_SIZE']))
+    except ValueError:
+        abort(400)
+    if per_page < 1 or per_page > current_app.config['PAGE_SIZE_MAX']:
+        abort(400)
+
+    booked_date = keys[0]
+    if start is not None:
+        query = query.filter(booked_date>=start)
+    if end is not None:
+        query = query.filter(booked_date<=end)
+    if room is not None:
+        query = query.filter(room_id==room)
+
+    try:
+        records, next_cursor = keyset_page(query, keys, request.args.get('cursor'), per_page, desc)
+    except ValueError:
+        abort(400)
+
+    filters = {k: request.args[k] for k in ('start', 'end', 'room', 'per_page', 'history') if request.args.get(k)}
+    return records, next_cursor, filters
+
+def listing_record(r):
+    """ JSON form of a listed reservation """
+    return {
+        'id': r.id,
+        'subject': r.subject,
+        'room': r.room_id,
+        'date': r.booked_date.isoformat(),
+        'time_start': r.time_start.strftime('%H:%M'),
+        'time_end': r.time_end.strftime('%H:%M'),
+        'party': r.party,
+        'username': r.username,
+        'booking_time': r.booking_time.isoformat(),
+        'status': r.status
+        }
 
 def update_records():
-    """ Updates all records' statuses """
-    past_records = db.session.query(Reservation.id, Reservation.booked_date, Reservation.time_start, Reservation.time_end).filter(Reservation.status!=2).all()
-
-    for r in past_records:
-        curr_stat = check_time_passed(r.booked_date, r.time_start, r.time_end)
-
-        # print(f'ID{r.id} Date: {r.booked_date}\t{r.time_end} stat:{curr_stat}')
-        db.session.query(Reservation).filter(Reservation.id==r.id).update(
-                dict(
-                    status=curr_stat))
-        db.session.commit()
-    
-def send_reminder():
-    """ Sends reminders to participants with D-1"""
-    reservations = db.session.query(Reservation).filter(and_(Reservation.reminder==False, Reservation.status==0)).all()
-    
-    for r in reservations:
-        date = r.booked_date
-        # 1 day before booked date
-        if check_time_diff(date) <= 1:
-            info = {
-                'subject':r.subject,
-                'date':r.booked_date,
-                'time_start':r.time_start,
-                'time_end':r.time_end,
-                'party':r.party,
-                'cancel_time': datetime.now().strftime('%H:%M:%S'),
-                'host': (current_user.name, current_user.username),
-                'message':r.message
-                }
-
-            party_emails = get_party_email([p.split(',')[0] for p in r.party])
-            reminder_html = render_template('mail.html', message='The meeting you\'re in is coming soon.', info=info)
-            send_msg(f'[VRRA] Meeting Reminder: <{info["subject"]}> ', party_emails, reminder_html)
-
-            db.session.query(Reservation).filter(Reservation.id==r.id).update(
-                dict(
-                    reminder=True))
-            db.session.commit()
-
+    """ Syncs stored statuses with the computed ones in a single UPDATE """
+    changed = db.session.query(Reservation).filter(Reservation._status!=Reservation.status).update(
+        {Reservation._status: Reservation.status}, synchronize_session=False)
+    db.session.commit()
+    return changed
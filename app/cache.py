@@ -0,0 +1,138 @@
+""" Versioned cache for rendered responses, in-process or shared through Redis """
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from flask import current_app, has_app_context
+
+
+class SimpleBackend(object):
+    """ In-process store, only consistent within one worker: entries live timeout seconds, so
+    changes another worker made show up after at most that long """
+
+    def __init__(self, max_entries=1024, max_versions=4096, timeout=60):
+        self.max_entries = max_entries
+        self.max_versions = max_versions
+        self.timeout = timeout
+        self.data = OrderedDict()
+        # versions are evicted apart from the values they version, see VersionedCache.current
+        self.versions = OrderedDict()
+        # never evicted, a reset clock could revive stale entries
+        self.counters = {}
+        self.kept = {}
+        self.lock = threading.Lock()
+
+    def window(self):
+        """ Counts up every timeout seconds and is added to counters, so a version read after its
+        entry expired is newer than any version handed out while it lived """
+        return int(time.monotonic() // self.timeout)
+
+    def counter(self, key):
+        with self.lock:
+            return self.counters.get(key, 0) + self.window()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.kept:
+                return self.kept[key]
+            for store in (self.versions, self.data):
+                if key in store:
+                    value, expires = store[key]
+                    if expires <= time.monotonic():
+                        del store[key]
+                        return None
+                    store.move_to_end(key)
+                    return value
+            return None
+
+    def set(self, key, value, pinned=False, keep=False):
+        with self.lock:
+            if keep:
+                self.kept[key] = value
+                return
+            store, limit = (self.versions, self.max_versions) if pinned else (self.data, self.max_entries)
+            store[key] = (value, time.monotonic() + self.timeout)
+            store.move_to_end(key)
+            while len(store) > limit:
+                store.popitem(last=False)
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key] + self.window()
+
+class RedisBackend(object):
+    """ Shared store so every gunicorn worker sees the same versions """
+
+    def __init__(self, url, timeout=24 * 3600, version_timeout=7 * 24 * 3600):
+        # optional dependency, only needed when STATUS_CACHE_URL is set
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.timeout = timeout
+        self.version_timeout = version_timeout
+
+    def get(self, key):
+        value = self.client.get(key)
+        return value.decode() if value is not None else None
+
+    def set(self, key, value, pinned=False, keep=False):
+        self.client.set(key, value, ex=None if keep else self.version_timeout if pinned else self.timeout)
+
+    def counter(self, key):
+        return int(self.client.get(key) or 0)
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+class VersionedCache(object):
+    """ Values stored per key are only served while the key's version is unchanged. Versions
+    are only written by bump(): they come from one clock counting every bump, so a key whose
+    version was never written or was evicted reads the clock and can't repeat an old version """
+
+    def __init__(self, app=None):
+        # outside an app context
+        self.default = SimpleBackend()
+        # Last-Modified of keys not bumped since the cache started
+        self.started = int(datetime.now(timezone.utc).timestamp())
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        url = app.config.get('STATUS_CACHE_URL')
+        app.extensions['versioned_cache'] = RedisBackend(url) if url else SimpleBackend(timeout=app.config['STATUS_CACHE_TTL'])
+
+    @property
+    def backend(self):
+        """ The current app's store, apps built side by side don't see each other's entries """
+        if has_app_context():
+            return current_app.extensions.get('versioned_cache', self.default)
+        return self.default
+
+    def current(self, key):
+        """ Gets the version of a key """
+        version = self.backend.get(f'{key}:version')
+        return int(version) if version is not None else self.backend.counter('clock:version')
+
+    def version(self, key):
+        """ Gets (version, last modified time) of a key, reads never write """
+        version = self.current(key)
+        modified = self.backend.get(f'{key}:modified') or self.backend.get('clock:modified') or self.started
+        return version, datetime.fromtimestamp(int(modified), timezone.utc)
+
+    def bump(self, key):
+        """ Invalidates everything stored for a key """
+        now = str(int(datetime.now(timezone.utc).timestamp()))
+        version = self.backend.incr('clock:version')
+        self.backend.set('clock:modified', now, keep=True)
+        self.backend.set(f'{key}:modified', now, pinned=True)
+        self.backend.set(f'{key}:version', version, pinned=True)
+        return version
+
+    def get(self, key, version):
+        return self.backend.get(f'{key}:{version}')
+
+    def set(self, key, version, value):
+        self.backend.set(f'{key}:{version}', value)
+
+cache = VersionedCache()
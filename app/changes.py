@@ -0,0 +1,52 @@
+""" Version counter of reservation changes, read by calendar feeds to send only what changed """
+from datetime import datetime
+
+from sqlalchemy import func
+
+from .models import db, CalendarTombstone, ChangeCounter, Reservation, User
+
+COUNTER = 'reservations'
+# highest version of a pruned tombstone, sync tokens before it can't be served incrementally
+PRUNED = 'tombstones_pruned'
+
+
+def next_version():
+    """ Increments the reservation change counter in the caller's transaction, gets the new value """
+    db.insert_or_ignore(ChangeCounter.__table__, name=COUNTER, value=0)
+    db.session.query(ChangeCounter).filter(ChangeCounter.name==COUNTER).update(
+        {ChangeCounter.value: ChangeCounter.value + 1}, synchronize_session=False)
+    return db.session.query(ChangeCounter.value).filter(ChangeCounter.name==COUNTER).scalar()
+
+def record_change(reservation_ids, usernames, removed=()):
+    """ Stamps changed reservations with a new version and moves the calendars of given users
+    and of the (reservation id, username) pairs in removed to it. Caller commits """
+    version = next_version()
+    if reservation_ids:
+        db.session.query(Reservation).filter(Reservation.id.in_(reservation_ids)).update(
+            {Reservation.version: version}, synchronize_session=False)
+
+    now = datetime.now()
+    for reservation_id, username in removed:
+        db.session.add(CalendarTombstone(reservation_id=reservation_id, username=username, version=version, removed_at=now))
+
+    users = set(usernames) | {username for _, username in removed}
+    if users:
+        db.session.query(User).filter(User.username.in_(users)).update(
+            {User.calendar_version: version}, synchronize_session=False)
+    return version
+
+def pruned_version():
+    """ Gets the highest version whose tombstones may be gone, 0 before any were pruned """
+    return db.session.query(ChangeCounter.value).filter(ChangeCounter.name==PRUNED).scalar() or 0
+
+def prune_tombstones(before):
+    """ Deletes tombstones of meetings removed before the given time and records the versions
+    they covered, caller commits """
+    tombstones = db.session.query(CalendarTombstone).filter(CalendarTombstone.removed_at < before)
+    highest = tombstones.with_entities(func.max(CalendarTombstone.version)).scalar()
+    if highest is None:
+        return
+    db.insert_or_ignore(ChangeCounter.__table__, name=PRUNED, value=0)
+    db.session.query(ChangeCounter).filter(ChangeCounter.name==PRUNED, ChangeCounter.value < highest).update(
+        {ChangeCounter.value: highest}, synchronize_session=False)
+    tombstones.delete(synchronize_session=False)
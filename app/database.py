@@ -0,0 +1,76 @@
+""" Database extension: connection pool and sqlite pragmas taken from the app config """
+from functools import partial
+from importlib import import_module
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, select
+from sqlalchemy.pool import QueuePool, StaticPool
+
+
+def apply_pragmas(pragmas, dbapi_connection, connection_record):
+    """ Runs on every new sqlite connection """
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+class Database(SQLAlchemy):
+    """ Pools sqlite connections and tunes them with SQLITE_PRAGMAS, other databases
+    only get SQLALCHEMY_ENGINE_OPTIONS """
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername.startswith('sqlite'):
+            options['sqlite_pragmas'] = app.config.get('SQLITE_PRAGMAS') or {}
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        # SQLALCHEMY_ENGINE_OPTIONS are only merged in after apply_driver_hacks
+        pragmas = engine_opts.pop('sqlite_pragmas', None)
+        if sa_url.drivername.startswith('sqlite'):
+            if engine_opts.get('poolclass') is StaticPool:
+                # in-memory database, a single shared connection
+                for key in ('pool_size', 'max_overflow', 'pool_timeout'):
+                    engine_opts.pop(key, None)
+            elif engine_opts.get('pool_size'):
+                # flask-sqlalchemy hooks in NullPool for sqlite files
+                engine_opts['poolclass'] = QueuePool
+                engine_opts.setdefault('connect_args', {})['check_same_thread'] = False
+
+        engine = super().create_engine(sa_url, engine_opts)
+        if pragmas:
+            event.listen(engine, 'connect', partial(apply_pragmas, pragmas))
+        return engine
+
+    def insert_or_ignore(self, table, **values):
+        """ Inserts a row unless its key exists, without failing when another worker just inserted it """
+        dialect = self.engine.dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            insert = import_module(f'sqlalchemy.dialects.{dialect}').insert
+            self.session.execute(insert(table).values(**values).on_conflict_do_nothing())
+        elif self.session.execute(table.select().where(
+                *(c==values[c.name] for c in table.primary_key))).first() is None:
+            self.session.execute(table.insert().values(**values))
+
+    def insert_all_or_ignore(self, table, rows):
+        """ insert_or_ignore for many rows, a single executemany on sqlite and postgresql """
+        dialect = self.engine.dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            insert = import_module(f'sqlalchemy.dialects.{dialect}').insert
+            self.session.execute(insert(table).on_conflict_do_nothing(), rows)
+        else:
+            for values in rows:
+                self.insert_or_ignore(table, **values)
+
+    def insert_all(self, table, rows):
+        """ Inserts rows and sets their 'id'. sqlite gets one executemany with ids after the current
+        maximum, the caller must have written in its transaction already: sqlite's write lock then
+        keeps anyone else from taking them until commit """
+        if self.engine.dialect.name == 'sqlite':
+            next_id = (self.session.execute(select(func.max(table.c.id))).scalar() or 0) + 1
+            for i, row in enumerate(rows):
+                row['id'] = next_id + i
+            self.session.execute(table.insert(), rows)
+        else:
+            for row in rows:
+                row['id'] = self.session.execute(table.insert(), row).inserted_primary_key[0]
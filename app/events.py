@@ -0,0 +1,46 @@
+""" In-process publisher pushing room status changes to server-sent-events subscribers """
+import json
+import queue
+import threading
+
+
+class Publisher(object):
+    """ Fans out every published event to all subscriber queues """
+
+    def __init__(self, max_pending=100):
+        self.max_pending = max_pending
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        q = queue.Queue(self.max_pending)
+        with self.lock:
+            self.subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.discard(q)
+
+    def publish(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers)
+
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                # subscriber fell behind, it has to refetch everything
+                self.unsubscribe(q)
+                with q.mutex:
+                    q.queue.clear()
+                q.put_nowait(None)
+
+def format_sse(data, event=None):
+    """ Formats one server-sent event """
+    msg = f'data: {json.dumps(data)}\n\n'
+    if event is not None:
+        msg = f'event: {event}\n' + msg
+    return msg
+
+publisher = Publisher()
@@ -0,0 +1,110 @@
+""" Per-user iCalendar feeds (/calendar/<token>.ics) with incremental sync tokens """
+import secrets
+from datetime import date, timedelta
+
+from flask import Blueprint, abort, current_app, flash, redirect, request, url_for
+from flask_login import current_user, login_required
+from sqlalchemy import null
+
+from .changes import pruned_version
+from .forms import CalendarFeedForm
+from .models import (
+    db, ArchivedParticipant, ArchivedReservation, CalendarTombstone, Reservation, ReservationParticipant, User
+)
+from .transfer import ICS_HEADER, ICS_DATETIME, fold, party_usernames, vevent
+from .users import invalidate_users
+
+feeds_bp = Blueprint('feeds', __name__)
+
+def contacts(rows):
+    """ username -> (name, email) of everyone taking part in given reservation rows, one query """
+    usernames = {u for r in rows for u in party_usernames(r._party)} | {r.username for r in rows}
+    if not usernames:
+        return {}
+    return {u.username: (u.name, u.email) for u in db.session.query(User.username, User.name, User.email).filter(
+        User.username.in_(usernames))}
+
+def render_feed(user, since=None):
+    """ The user's meetings as an iCalendar feed. A full feed covers FEED_PAST_DAYS back, archived
+    meetings included, with since only meetings changed after that version and cancelled ones are sent """
+    query = db.session.query(Reservation.id, Reservation.username, Reservation.subject, Reservation.room_id,
+        Reservation.booking_time, Reservation.updated_at, Reservation.booked_date, Reservation.time_start,
+        Reservation.time_end, Reservation._party, Reservation.message, Reservation.version).join(
+        ReservationParticipant, ReservationParticipant.reservation_id==Reservation.id).filter(
+        ReservationParticipant.username==user.username)
+    if since is None:
+        start = date.today() - timedelta(days=current_app.config['FEED_PAST_DAYS'])
+        rows = query.filter(ReservationParticipant.booked_date >= start).all()
+        # archive-reservations moves meetings out after ARCHIVE_AFTER_DAYS, maybe before they leave the window.
+        # they can't change anymore, their SEQUENCE is left out
+        rows += db.session.query(ArchivedReservation.id, ArchivedReservation.username, ArchivedReservation.subject,
+            ArchivedReservation.room_id, ArchivedReservation.booking_time, null().label('updated_at'),
+            ArchivedReservation.booked_date, ArchivedReservation.time_start, ArchivedReservation.time_end,
+            ArchivedReservation._party, ArchivedReservation.message, null().label('version')).join(
+            ArchivedParticipant, ArchivedParticipant.archive_id==ArchivedReservation.archive_id).filter(
+            ArchivedParticipant.username==user.username, ArchivedParticipant.booked_date >= start).all()
+    else:
+        rows = query.filter(Reservation.version > since).all()
+    rows.sort(key=lambda r: (r.booked_date, r.time_start))
+
+    parts = [ICS_HEADER, fold(f'X-WR-CALNAME:Meetings of {user.name}'), f'X-VRRA-SYNC-TOKEN:{user.calendar_version}\r\n']
+    users = contacts(rows)
+    for r in rows:
+        stamp = (r.updated_at or r.booking_time).strftime(ICS_DATETIME)
+        sequence = (f'SEQUENCE:{r.version}',) if r.version is not None else ()
+        parts.append(vevent(r, users, sequence + (f'LAST-MODIFIED:{stamp}',)))
+
+    if since is not None:
+        live = {r.id for r in rows}
+        for t in db.session.query(CalendarTombstone).filter(
+                CalendarTombstone.username==user.username, CalendarTombstone.version > since).order_by(CalendarTombstone.version):
+            # a meeting the user left and was invited back to is sent as it is now
+            if t.reservation_id not in live:
+                live.add(t.reservation_id)
+                parts.append(f'BEGIN:VEVENT\r\nUID:reservation-{t.reservation_id}@vrra\r\n'
+                    f'DTSTAMP:{t.removed_at.strftime(ICS_DATETIME)}\r\nSEQUENCE:{t.version}\r\nSTATUS:CANCELLED\r\nEND:VEVENT\r\n')
+    parts.append('END:VCALENDAR\r\n')
+    return ''.join(parts)
+
+@feeds_bp.route('/calendar/<token>.ics')
+def calendar_feed(token):
+    """ Subscribable feed, ?since=<X-VRRA-SYNC-TOKEN of an earlier response> gets only the changes """
+    try:
+        since = int(request.args['since']) if request.args.get('since') else None
+    except ValueError:
+        abort(400)
+    if since is not None and since < 0:
+        abort(400)
+
+    user = db.session.query(User.username, User.name, User.calendar_version).filter(User.calendar_token==token).first()
+    if user is None:
+        abort(404)
+    # cancellations after a token this old may have been pruned, the client gets everything again
+    if since is not None and since < pruned_version():
+        since = None
+
+    # book/edit/cancel move calendar_version of everyone involved, unchanged feeds end here.
+    # the full feed's window moves every day
+    etag = f'{user.calendar_version}-{since}' if since is not None else f'{user.calendar_version}-{date.today().isoformat()}'
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(render_feed(user, since), mimetype='text/calendar')
+    response.set_etag(etag)
+    response.headers['X-Sync-Token'] = str(user.calendar_version)
+    response.cache_control.no_cache = True
+    return response
+
+@feeds_bp.route('/calendar/subscribe', methods=('POST',))
+@login_required
+def subscribe():
+    """ Creates a new feed url for the current user, the old one stops working """
+    if not CalendarFeedForm().validate_on_submit():
+        abort(400)
+    db.session.query(User).filter(User.id==current_user.id).update(
+        {User.calendar_token: secrets.token_urlsafe(24)}, synchronize_session=False)
+    db.session.commit()
+    # current_user comes from the user cache
+    invalidate_users()
+    flash('Your calendar feed url was created, add it to your calendar app.', 'success')
+    return redirect(url_for('booking.profile'))
@@ -1,11 +1,14 @@
 from flask_wtf import FlaskForm
 from wtforms import  (
-    StringField, PasswordField, RadioField, SelectMultipleField, SelectField, DateField,
+    StringField, PasswordField, RadioField, SelectMultipleField, SelectField, DateField, IntegerField, BooleanField,
 )
-from wtforms.validators import DataRequired, Email
+from wtforms.validators import DataRequired, Email, NumberRange, Optional, ValidationError
 from wtforms.widgets.core import ListWidget, CheckboxInput
 from datetime import datetime
-from config import OPEN_HOURS, NO_OF_ROOMS
+from config import OPEN_HOURS
+
+# longest series a recurring reservation expands into
+MAX_OCCURRENCES = 100
 
 class RegisterForm(FlaskForm):
     username = StringField(u'username', validators=[DataRequired()])
@@ -17,20 +20,46 @@ class LoginForm(FlaskForm):
     username = StringField(u'username', validators=[DataRequired()])
     password = PasswordField(u'password', validators=[DataRequired()])
 
-class ReservationForm(FlaskForm):
-    start_hour_choices = [(i,str(i).zfill(2)+':00')for i in range(OPEN_HOURS[0], OPEN_HOURS [1])]
-    end_hour_choices = [(i+1,str(i+1).zfill(2)+':00')for i in range(OPEN_HOURS[0], OPEN_HOURS [1])]
+class CalendarFeedForm(FlaskForm):
+    """ No fields, posting it (re)creates the user's feed url behind the csrf check """
+
+class NotificationForm(FlaskForm):
+    digest = BooleanField(u'daily digest')
+
+def start_hour_choices():
+    return [(i,str(i).zfill(2)+':00')for i in range(OPEN_HOURS[0], OPEN_HOURS [1])]
 
-    check = [t[0] for t in end_hour_choices]
-    if 24 in check:
-        end_hour_choices[check.index(24)] = (24,'00:00')
+def end_hour_choices():
+    # the last hour ends at midnight
+    return [(i+1,str((i+1) % 24).zfill(2)+':00')for i in range(OPEN_HOURS[0], OPEN_HOURS [1])]
 
-    room_choices = [(i, 'R'+ str(i)) for i in range(1, NO_OF_ROOMS+1)]
+class ReservationForm(FlaskForm):
+    repeat_choices = [('none', 'Does not repeat'), ('daily', 'Daily'), ('weekly', 'Weekly')]
 
     subject = StringField(u'subject', default='Meeting')
-    room_id = RadioField(u'room', choices=room_choices, validators=[DataRequired()], widget=ListWidget())
+    # choices are the page of rooms the view shows, any existing room may be posted
+    room_id = RadioField(u'room', choices=[], coerce=int, validate_choice=False, validators=[DataRequired()], widget=ListWidget())
     booked_date = DateField(u'current_date', default=datetime.today, validators=[DataRequired()])
+    # hour choices are built when a form is created
     time_start = SelectField(u'start_time', choices=start_hour_choices, validators=[DataRequired()])
     time_end = SelectField(u'end_time', choices=end_hour_choices, validators=[DataRequired()])
     party = SelectMultipleField(u'party', widget=ListWidget(prefix_label=True), option_widget=CheckboxInput())
     message = StringField(u'message')
+    # recurrence, 'every' counts days or weeks depending on repeat
+    repeat = SelectField(u'repeat', choices=repeat_choices, default='none')
+    interval = IntegerField(u'every', default=1, validators=[Optional(), NumberRange(min=1, max=52)])
+    until = DateField(u'until', validators=[Optional()])
+    count = IntegerField(u'occurrences', validators=[Optional(), NumberRange(min=1, max=MAX_OCCURRENCES)])
+
+    def validate_time_end(self, field):
+        # end hours run up to 24, midnight
+        if field.data and self.time_start.data and int(field.data) <= int(self.time_start.data):
+            raise ValidationError('The meeting must end after it starts.')
+
+    def validate_repeat(self, field):
+        if field.data != 'none' and not self.until.data and not self.count.data:
+            raise ValidationError('A repeating meeting needs an end date or a number of occurrences.')
+
+    def validate_until(self, field):
+        if field.data and self.booked_date.data and field.data < self.booked_date.data:
+            raise ValidationError('Repeat until must not be before the first date.')
@@ -0,0 +1,119 @@
+""" Password hashing in a bounded pool of worker processes, so a burst of logins doesn't hold
+request threads (and the CPU they share) on PBKDF2 """
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app, has_app_context
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from .metrics import metrics
+
+
+class HasherBusy(Exception):
+    """ More hashes are waiting than PASSWORD_HASH_QUEUE allows, the caller should retry later """
+
+def hash_method(method, iterations):
+    """ werkzeug method string, pbkdf2 methods carry their iteration count """
+    return f'{method}:{iterations}' if method.startswith('pbkdf2') and iterations else method
+
+class PasswordHasher(object):
+    """ Hashes and checks passwords in PASSWORD_HASH_WORKERS processes, started on first use.
+    With no workers, in a daemonic process or when the pool can't start, hashing runs in the
+    calling thread """
+
+    def __init__(self, app=None):
+        self.method = hash_method('pbkdf2:sha256', 260000)
+        self.workers = 0
+        self.max_pending = 0
+        self.timeout = None
+        self.pending = 0
+        self.executor = None
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = hash_method(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_ITERATIONS'])
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.max_pending = app.config['PASSWORD_HASH_QUEUE']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        app.extensions['password_hasher'] = self
+
+    def generate(self, password):
+        return self.run(generate_password_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        return self.run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """ True for hashes made with another method or iteration count than configured """
+        return pwhash.split('$', 1)[0] != self.method
+
+    def run(self, func, *args):
+        # daemonic processes (multiprocessing.Pool workers, some worker hosts) may not have children
+        if not self.workers or multiprocessing.current_process().daemon:
+            return func(*args)
+
+        with self.lock:
+            if self.pending >= self.max_pending:
+                metrics.password_hash_rejected.inc()
+                raise HasherBusy()
+            self.pending += 1
+            if self.executor is None:
+                # forking a process that runs request, mail and scheduler threads can copy held locks
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            executor = self.executor
+        try:
+            future = executor.submit(func, *args)
+        except BrokenProcessPool as e:
+            self.release()
+            self.discard(executor, e)
+            raise
+        except Exception as e:
+            self.release()
+            self.disable(executor, e)
+            return func(*args)
+        # a hash that timed out still holds its place until a worker finished it
+        future.add_done_callback(self.release)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise HasherBusy()
+        except BrokenProcessPool as e:
+            self.discard(executor, e)
+            raise
+
+    def discard(self, executor, error):
+        """ A pool whose worker died takes no more work, the next hash starts a new one """
+        if isinstance(error, BrokenProcessPool):
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = None
+
+    def disable(self, executor, error):
+        """ The pool's processes couldn't be started, this process hashes inline from now on """
+        with self.lock:
+            self.workers = 0
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+        if has_app_context():
+            current_app.logger.warning('Password hashing pool failed to start, hashing inline: %r', error)
+
+    def release(self, future=None):
+        with self.lock:
+            self.pending -= 1
+
+    def queued(self):
+        """ Hashes submitted and not finished yet, for the metrics gauge """
+        return self.pending
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
+
+hasher = PasswordHasher()
@@ -1,9 +1,212 @@
+""" Outbound mail: handlers enqueue into the outbox, the mail worker delivers """
+import socketserver
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
 from flask_mail import Mail, Message
+from sqlalchemy import func, or_
+
+from .metrics import metrics
+from .models import db, OutboundMail
+from .notify import flush_notifications
 
 mail = Mail()
 
-def send_msg(subject, recipients, html):
-    msg = Message(subject=subject, 
-                recipients=recipients,
-                html=html)
-    mail.send(msg)
\ No newline at end of file
+def send_msg(subject, recipients, html, commit=True):
+    """ Queues a message in the outbox, delivered later by the mail worker """
+    # recipients are either addresses or (name, address) rows
+    recipients = [r if isinstance(r, str) else list(r) for r in recipients]
+    db.session.add(OutboundMail(subject, recipients, html))
+    metrics.mail_queued.inc()
+    if commit:
+        db.session.commit()
+
+def outbox_pending():
+    """ Number of messages waiting to be sent or retried """
+    return db.session.query(func.count(OutboundMail.id)).filter(OutboundMail.next_attempt_at!=None).scalar()
+
+def claim_batch(worker, batch_size, lease=timedelta(minutes=5)):
+    """ Locks due outbox messages for this worker so other workers skip them """
+    now = datetime.now()
+    free = or_(OutboundMail.locked_until==None, OutboundMail.locked_until<now)
+
+    ids = [m.id for m in db.session.query(OutboundMail.id).filter(
+        OutboundMail.next_attempt_at<=now, free).order_by(OutboundMail.next_attempt_at).limit(batch_size)]
+    if not ids:
+        return []
+
+    locked_until = now + lease
+    db.session.query(OutboundMail).filter(OutboundMail.id.in_(ids), free).update(
+        dict(locked_until=locked_until, worker=worker), synchronize_session=False)
+    db.session.commit()
+
+    return db.session.query(OutboundMail).filter(
+        OutboundMail.worker==worker, OutboundMail.locked_until==locked_until).all()
+
+def mark_failed(msg, error):
+    """ Schedules a retry with exponential backoff, gives up after MAIL_MAX_ATTEMPTS """
+    msg.attempts += 1
+    msg.last_error = str(error)[:500]
+    msg.locked_until = None
+
+    if msg.attempts >= current_app.config['MAIL_MAX_ATTEMPTS']:
+        msg.next_attempt_at = None
+    else:
+        backoff = current_app.config['MAIL_RETRY_BACKOFF'] * 2 ** (msg.attempts - 1)
+        msg.next_attempt_at = datetime.now() + timedelta(seconds=backoff)
+
+def deliver(batch, conn):
+    """ Sends claimed messages over an open connection, returns number sent """
+    sent = 0
+    for msg in batch:
+        start = time.perf_counter()
+        try:
+            conn.send(Message(subject=msg.subject, recipients=msg.recipient_list, html=msg.html))
+        except Exception as e:
+            metrics.mail_failures.inc()
+            mark_failed(msg, e)
+        else:
+            metrics.mail_latency.observe(time.perf_counter() - start)
+            msg.sent_at = datetime.now()
+            msg.next_attempt_at = None
+            msg.locked_until = None
+            sent += 1
+    db.session.commit()
+    return sent
+
+def drain_outbox(worker, batch_size):
+    """ Queues due meeting notifications, then sends due messages batch by batch over
+    one SMTP connection, returns number sent """
+    sent = 0
+    flush_notifications()
+    batch = claim_batch(worker, batch_size)
+    if not batch:
+        return 0
+
+    try:
+        # keep the connection open for as long as there is work
+        with mail.connect() as conn:
+            while batch:
+                sent += deliver(batch, conn)
+                batch = claim_batch(worker, batch_size)
+    except Exception as e:
+        # connecting failed or the server dropped us, retry what was claimed
+        for msg in batch:
+            if msg.sent_at is None and msg.locked_until is not None:
+                metrics.mail_failures.inc()
+                mark_failed(msg, e)
+        db.session.commit()
+    return sent
+
+class MailWorkerPool(object):
+    """ Threads draining the outbox, each with its own app context and SMTP connection """
+
+    def __init__(self, app, workers=2, batch_size=50, poll_interval=2):
+        self.app = app
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def run_worker(self, name):
+        with self.app.app_context():
+            while not self.stopping.is_set():
+                try:
+                    sent = drain_outbox(name, self.batch_size)
+                except Exception:
+                    self.app.logger.exception('Mail worker %s failed', name)
+                    db.session.rollback()
+                    sent = 0
+                finally:
+                    db.session.remove()
+
+                if not sent:
+                    self.stopping.wait(self.poll_interval)
+
+    def start(self):
+        prefix = uuid.uuid4().hex[:8]
+        for i in range(self.workers):
+            t = threading.Thread(target=self.run_worker, args=(f'{prefix}-{i}',), daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        self.stopping.set()
+        for t in self.threads:
+            t.join()
+
+class DebugSMTPHandler(socketserver.StreamRequestHandler):
+    """ Speaks just enough SMTP for smtplib, keeps messages instead of delivering """
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        self.reply('220 localhost debugging SMTP server')
+        envelope = {'from': None, 'to': []}
+
+        for raw in self.rfile:
+            line = raw.decode(errors='replace').rstrip('\r\n')
+            command = line[:4].upper()
+
+            if command in ('HELO', 'EHLO'):
+                self.reply('250 localhost')
+            elif command == 'MAIL':
+                envelope = {'from': line[10:].strip(), 'to': []}
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                envelope['to'].append(line[8:].strip())
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for raw in self.rfile:
+                    if raw.rstrip(b'\r\n') == b'.':
+                        break
+                    data.append(raw)
+                self.server.received(envelope, b''.join(data))
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                # RSET, NOOP, ...
+                self.reply('250 OK')
+
+class DebugSMTPServer(socketserver.ThreadingTCPServer):
+    """ Local SMTP stand-in for offline runs, messages are kept in memory """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=1025, echo=True):
+        super().__init__((host, port), DebugSMTPHandler)
+        self.echo = echo
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def received(self, envelope, data):
+        with self.lock:
+            self.messages.append((envelope, data))
+        if self.echo:
+            click.echo(f'[debug-smtp] {envelope["from"]} -> {", ".join(envelope["to"])} ({len(data)} bytes)')
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+def use_debug_smtp(app, port):
+    """ Points the app's mail settings at a local debugging SMTP server """
+    app.config.update(
+        MAIL_SERVER='127.0.0.1',
+        MAIL_PORT=port,
+        MAIL_USE_SSL=False,
+        MAIL_USE_TLS=False,
+        MAIL_USERNAME=None,
+        MAIL_PASSWORD=None,
+        MAIL_SUPPRESS_SEND=False)
+    mail.init_app(app)
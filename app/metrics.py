@@ -0,0 +1,206 @@
+""" Request, SQL and mail instrumentation, rendered in Prometheus text format at /metrics """
+import threading
+import time
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+# statements kept per request for the slow request log
+MAX_LOGGED_STATEMENTS = 100
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter(object):
+    """ Monotonic value per label set """
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name + format_labels(self.labels, k), v) for k, v in sorted(self.values.items())]
+
+class Histogram(object):
+    """ Cumulative bucket counts, sum and count per label set """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}    # labels -> [per bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts = self.values.setdefault(labels, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for k, counts in sorted(self.values.items()):
+                for bound, n in zip(self.buckets, counts):
+                    samples.append((self.name + '_bucket' + format_labels(self.labels, k, f'le="{bound}"'), n))
+                samples.append((self.name + '_bucket' + format_labels(self.labels, k, 'le="+Inf"'), counts[-2]))
+                samples.append((self.name + '_sum' + format_labels(self.labels, k), counts[-1]))
+                samples.append((self.name + '_count' + format_labels(self.labels, k), counts[-2]))
+        return samples
+
+class Gauge(object):
+    """ Value read by a callback at scrape time """
+    kind = 'gauge'
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self):
+        value = self.read()
+        return [] if value is None else [(self.name, value)]
+
+class Metrics(object):
+    """ Collects metrics of one process, hooks into the app and every SQLAlchemy engine """
+
+    def __init__(self):
+        self.request_latency = Histogram('vrra_request_duration_seconds',
+            'Time spent handling requests', ('endpoint', 'method', 'status'))
+        self.request_statements = Histogram('vrra_request_sql_statements',
+            'SQL statements executed per request', ('endpoint',), STATEMENT_BUCKETS)
+        self.request_sql_seconds = Counter('vrra_request_sql_seconds_total',
+            'Time spent in SQL statements during requests', ('endpoint',))
+        self.sql_statements = Counter('vrra_sql_statements_total', 'SQL statements executed')
+        self.sql_seconds = Counter('vrra_sql_seconds_total', 'Time spent in SQL statements')
+        self.mail_queued = Counter('vrra_mail_queued_total', 'Messages added to the outbox')
+        self.mail_latency = Histogram('vrra_mail_send_duration_seconds', 'Time spent sending a message over SMTP')
+        self.mail_failures = Counter('vrra_mail_send_failures_total', 'Messages the SMTP server did not accept')
+        self.notifications = Counter('vrra_notifications_total', 'Meeting changes queued for notification', ('kind',))
+        self.notifications_saved = Counter('vrra_notification_sends_saved_total',
+            'Notifications to a recipient merged into another message or cancelled out')
+        self.password_hash_rejected = Counter('vrra_password_hash_rejected_total',
+            'Logins and registrations turned away because too many hashes were waiting')
+        self.metrics = [self.request_latency, self.request_statements, self.request_sql_seconds,
+            self.sql_statements, self.sql_seconds, self.mail_queued, self.mail_latency, self.mail_failures,
+            self.notifications, self.notifications_saved, self.password_hash_rejected]
+        self.slow_threshold = None
+
+    def init_app(self, app):
+        threshold = app.config.get('SLOW_REQUEST_THRESHOLD_MS')
+        self.slow_threshold = threshold / 1000 if threshold else None
+
+        if not event.contains(Engine, 'before_cursor_execute', self.before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+            event.listen(Engine, 'handle_error', self.handle_error)
+
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    def add_gauge(self, name, help, read):
+        # every app create_app builds adds its gauges again
+        self.metrics = [m for m in self.metrics if m.name != name]
+        self.metrics.append(Gauge(name, help, read))
+
+    def before_request(self):
+        g.metrics_start = time.perf_counter()
+        g.sql_count = 0
+        g.sql_time = 0.0
+        g.sql_log = [] if self.slow_threshold is not None else None
+
+    def after_request(self, response):
+        if 'metrics_start' not in g or request.endpoint == 'metrics':
+            return response
+        elapsed = time.perf_counter() - g.metrics_start
+        endpoint = request.endpoint or 'unmatched'
+
+        self.request_latency.observe(elapsed, endpoint, request.method, response.status_code)
+        self.request_statements.observe(g.sql_count, endpoint)
+        self.request_sql_seconds.inc(endpoint, amount=g.sql_time)
+
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            lines = [f'{ms:8.2f} ms  {statement}' for statement, ms in g.sql_log]
+            if g.sql_count > len(lines):
+                lines.append(f'... {g.sql_count - len(lines)} more')
+            current_app.logger.warning('Slow request %s %s: %.0f ms, %d statements in %.0f ms\n%s',
+                request.method, request.full_path.rstrip('?'), elapsed * 1000, g.sql_count, g.sql_time * 1000,
+                '\n'.join(lines))
+        return response
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['metrics_start'].pop()
+        self.sql_statements.inc()
+        self.sql_seconds.inc(amount=elapsed)
+
+        if has_request_context() and 'sql_count' in g:
+            g.sql_count += 1
+            g.sql_time += elapsed
+            if g.sql_log is not None and len(g.sql_log) < MAX_LOGGED_STATEMENTS:
+                g.sql_log.append((' '.join(statement.split()), elapsed * 1000))
+
+    def handle_error(self, context):
+        # a failed statement never reaches after_cursor_execute
+        if context.connection is not None and context.cursor is not None:
+            starts = context.connection.info.get('metrics_start')
+            if starts:
+                starts.pop()
+
+    def render(self):
+        """ All metrics in Prometheus text exposition format """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name} {value}' for name, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def metrics_view(self):
+        return self.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+    def serve(self, app, port, host='0.0.0.0'):
+        """ Exposes the metrics of a process without a web server (mail worker, scheduler) """
+        def wsgi_app(environ, start_response):
+            with app.app_context():
+                body = self.render().encode()
+            start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')])
+            return [body]
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_message(self, *args):
+                pass
+
+        server = make_server(host, port, wsgi_app, handler_class=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+metrics = Metrics()
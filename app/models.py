@@ -1,7 +1,13 @@
 """ Database models classes defined here """
-from flask_sqlalchemy import SQLAlchemy
+import json
+from datetime import datetime, time
+from sqlalchemy import and_, case
+from sqlalchemy.ext.hybrid import hybrid_property
 
-db = SQLAlchemy()
+from config import OPEN_HOURS
+from .database import Database
+
+db = Database()
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -10,6 +16,16 @@ class User(db.Model):
     email = db.Column(db.String, unique=True, nullable=False)
     password = db.Column(db.String, nullable=False)
     admin = db.Column(db.Boolean, nullable=False, default=False)
+    # secret part of the /calendar/<token>.ics feed url, None until subscribed
+    calendar_token = db.Column(db.String)
+    # change counter value of the last change to any of the user's meetings
+    calendar_version = db.Column(db.Integer, nullable=False, default=0)
+    # meeting notifications once a day instead of after every change
+    notify_digest = db.Column(db.Boolean, nullable=False, default=False)
+
+    __table_args__ = (
+        db.Index('ix_user_calendar_token', 'calendar_token', unique=True),
+    )
 
     def __init__(self, username, name, email, password, admin=False):
         self.username = username
@@ -17,6 +33,8 @@ class User(db.Model):
         self.email = email
         self.password = password
         self.admin = admin
+        self.calendar_version = 0
+        self.notify_digest = False
 
     def is_authenticated(self):
         return True
@@ -32,6 +50,10 @@ class User(db.Model):
     def get_id(self):
         return self.id
 
+def format_party(party_list):
+    """ Stored form of a party, 'username, name' entries separated by ';' """
+    return ';'.join(f'{name}'.replace("'", "").strip("() ") for name in party_list)
+
 class Reservation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username  = db.Column(db.String, nullable=False)
@@ -44,7 +66,24 @@ class Reservation(db.Model):
     _party = db.Column(db.String)
     message = db.Column(db.String)
     reminder = db.Column(db.Boolean, nullable=False)
-    status = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime)     # picked up by the reminder scheduler
+    version = db.Column(db.Integer, nullable=False, default=0)     # change counter value of the last change
+    # last synced value, read the computed status property instead
+    _status = db.Column('status', db.Integer, nullable=False)
+    participants = db.relationship('ReservationParticipant', cascade='all, delete-orphan')
+
+    __table_args__ = (
+        # status table, room and party checks
+        db.Index('ix_reservation_booked_date_room_id', 'booked_date', 'room_id'),
+        # keyset pages of /index, the implicit rowid completes (booked_date, time_start, id)
+        db.Index('ix_reservation_booked_date_time_start', 'booked_date', 'time_start'),
+        # profile
+        db.Index('ix_reservation_username_booked_date', 'username', 'booked_date'),
+        # reminder scheduler
+        db.Index('ix_reservation_reminder_updated_at', 'reminder', 'updated_at'),
+        # incremental calendar feeds
+        db.Index('ix_reservation_version', 'version'),
+    )
 
     def __init__(self, username, subject, room_id, booking_time, booked_date, time_start, time_end, party_list, message, reminder=False):
         self.username  = username 
@@ -54,15 +93,247 @@ class Reservation(db.Model):
         self.booked_date = booked_date
         self.time_start = time_start
         self.time_end = time_end
-        self._party = ';'.join(f'{name}'.replace("'", "").strip("() ") for name in party_list)
+        self._party = format_party(party_list)
         self.message = message
         self.reminder = reminder
-        self.status = 0     # 0: coming soon; 1: ongoing; 2: expired
+        self.updated_at = booking_time
+        self.version = 0
+        self._status = 0
+        self.participants = [ReservationParticipant(p[0], booked_date) for p in party_list]
 
     @property
     def party(self):
         return [name for name in self._party.split(';')]
     @party.setter
     def party(self, names):
-        self._party = ';'.join(f'{n}'.replace("'", "").strip("() ") for n in names)
+        self._party = format_party(names)
+
+    @hybrid_property
+    def status(self):
+        """ 0: coming soon; 1: ongoing; 2: expired, evaluated at current hour """
+        now = datetime.now()
+        if self.booked_date != now.date():
+            return 2 if self.booked_date < now.date() else 0
+
+        time_end = self.time_end.hour if self.time_end.hour != 0 else 24
+        if time_end <= now.hour:
+            return 2
+        return 1 if self.time_start.hour <= now.hour else 0
+
+    @status.expression
+    def status(cls):
+        now = datetime.now()
+        hour = time(now.hour)
+        return case(
+            (cls.booked_date < now.date(), 2),
+            (cls.booked_date > now.date(), 0),
+            (and_(cls.time_end != time(0), cls.time_end <= hour), 2),
+            (cls.time_start <= hour, 1),
+            else_=0)
+
+class ReservationParticipant(db.Model):
+    """ Usernames taking part in a reservation (host included), one row each """
+    __tablename__ = 'reservation_participant'
+    reservation_id = db.Column(db.Integer, db.ForeignKey('reservation.id'), primary_key=True)
+    username = db.Column(db.String, primary_key=True)
+    # copied from the reservation so conflict checks stay on one index
+    booked_date = db.Column(db.Date, nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_reservation_participant_username_date', 'username', 'booked_date'),
+    )
+
+    def __init__(self, username, booked_date, reservation_id=None):
+        self.username = username
+        self.booked_date = booked_date
+        self.reservation_id = reservation_id
+
+class ArchivedReservation(db.Model):
+    """ Reservation moved out of the hot table by flask archive-reservations """
+    __tablename__ = 'archived_reservation'
+    # sqlite may hand an archived reservation's id out again, so it isn't the key here
+    archive_id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, nullable=False, index=True)
+    username  = db.Column(db.String, nullable=False)
+    subject = db.Column(db.String, nullable=False)
+    room_id = db.Column(db.Integer, nullable=False)
+    booking_time = db.Column(db.DateTime, nullable=False)
+    booked_date = db.Column(db.Date, nullable=False)
+    time_start = db.Column(db.Time, nullable=False)
+    time_end = db.Column(db.Time, nullable=False)
+    _party = db.Column(db.String)
+    message = db.Column(db.String)
+    archived_at = db.Column(db.DateTime, nullable=False)
+    participants = db.relationship('ArchivedParticipant', cascade='all, delete-orphan')
+
+    def __init__(self, reservation, archived_at):
+        for column in ('id', 'username', 'subject', 'room_id', 'booking_time', 'booked_date',
+                'time_start', 'time_end', '_party', 'message'):
+            setattr(self, column, getattr(reservation, column))
+        self.archived_at = archived_at
+        self.participants = [ArchivedParticipant(p.username, p.booked_date) for p in reservation.participants]
+
+    @property
+    def party(self):
+        return [name for name in self._party.split(';')]
+
+    @property
+    def status(self):
+        """ Only expired reservations are archived """
+        return 2
+
+class ArchivedParticipant(db.Model):
+    """ Participants of an archived reservation, for the profile history """
+    __tablename__ = 'archived_participant'
+    archive_id = db.Column(db.Integer, db.ForeignKey('archived_reservation.archive_id'), primary_key=True)
+    username = db.Column(db.String, primary_key=True)
+    booked_date = db.Column(db.Date, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_archived_participant_username_date', 'username', 'booked_date'),
+    )
+
+    def __init__(self, username, booked_date, archive_id=None):
+        self.username = username
+        self.booked_date = booked_date
+        self.archive_id = archive_id
+
+class Room(db.Model):
+    """ A bookable room, open_hour and close_hour lie within config.OPEN_HOURS """
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String, nullable=False)
+    site = db.Column(db.String, nullable=False, default='')
+    capacity = db.Column(db.Integer, nullable=False, default=0)
+    open_hour = db.Column(db.Integer, nullable=False)
+    close_hour = db.Column(db.Integer, nullable=False)     # 24 is midnight
+    equipment = db.relationship('RoomEquipment', cascade='all, delete-orphan', lazy='selectin')
+
+    __table_args__ = (
+        # room search, a site's rooms by size
+        db.Index('ix_room_site_capacity', 'site', 'capacity'),
+        db.Index('ix_room_capacity', 'capacity'),
+    )
+
+    def __init__(self, name, site='', capacity=0, open_hour=None, close_hour=None, equipment=()):
+        self.name = name
+        self.site = site
+        self.capacity = capacity
+        self.open_hour = OPEN_HOURS[0] if open_hour is None else open_hour
+        self.close_hour = OPEN_HOURS[1] if close_hour is None else close_hour
+        self.equipment = [RoomEquipment(item) for item in dict.fromkeys(equipment)]
+
+    @property
+    def items(self):
+        return sorted(e.item for e in self.equipment)
+
+class RoomEquipment(db.Model):
+    """ Equipment items of a room, keyed by item first so a search by item stays on the index """
+    __tablename__ = 'room_equipment'
+    item = db.Column(db.String, primary_key=True)
+    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), primary_key=True)
+
+    def __init__(self, item, room_id=None):
+        self.item = item
+        self.room_id = room_id
+
+class RoomOccupancy(db.Model):
+    """ Hours booked per room per day, bit h set when hour h is taken """
+    __tablename__ = 'room_occupancy'
+    room_id = db.Column(db.Integer, primary_key=True)
+    booked_date = db.Column(db.Date, primary_key=True)
+    hours = db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, room_id, booked_date, hours=0):
+        self.room_id = room_id
+        self.booked_date = booked_date
+        self.hours = hours
+
+class RoomUsageDaily(db.Model):
+    """ Rollup of a room's bookings per day for analytics, kept by every booking change and left
+    in place when reservations are archived """
+    __tablename__ = 'room_usage_daily'
+    room_id = db.Column(db.Integer, primary_key=True)
+    usage_date = db.Column(db.Date, primary_key=True)
+    hours = db.Column(db.Integer, nullable=False, default=0)         # bit h set when hour h is booked
+    meetings = db.Column(db.Integer, nullable=False, default=0)
+    seat_hours = db.Column(db.Integer, nullable=False, default=0)    # participants times hours, summed
+
+    __table_args__ = (
+        db.Index('ix_room_usage_daily_usage_date', 'usage_date'),
+    )
+
+    def __init__(self, room_id, usage_date, hours=0, meetings=0, seat_hours=0):
+        self.room_id = room_id
+        self.usage_date = usage_date
+        self.hours = hours
+        self.meetings = meetings
+        self.seat_hours = seat_hours
+
+class ChangeCounter(db.Model):
+    """ Named counters incremented in the writing transaction, 'reservations' versions calendar feeds """
+    __tablename__ = 'change_counter'
+    name = db.Column(db.String, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class CalendarTombstone(db.Model):
+    """ A meeting that left a user's calendar (cancelled or uninvited), for incremental feeds """
+    __tablename__ = 'calendar_tombstone'
+    id = db.Column(db.Integer, primary_key=True)
+    reservation_id = db.Column(db.Integer, nullable=False)
+    username = db.Column(db.String, nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    removed_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_calendar_tombstone_username_version', 'username', 'version'),
+    )
+
+class PendingNotification(db.Model):
+    """ Meeting change held back to be merged into the recipient's next message """
+    __tablename__ = 'pending_notification'
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String, nullable=False)
+    email = db.Column(db.String, nullable=False)
+    reservation_id = db.Column(db.Integer)      # None for changes never merged, e.g. a booked series
+    kind = db.Column(db.String, nullable=False)     # invited, modified, removed or cancelled
+    subject = db.Column(db.String, nullable=False)
+    message = db.Column(db.String, nullable=False)
+    info = db.Column(db.Text, nullable=False)       # JSON of the mail.html info
+    created_at = db.Column(db.DateTime, nullable=False)
+    due_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_pending_notification_due_at', 'due_at'),
+        db.Index('ix_pending_notification_username', 'username'),
+    )
+
+class OutboundMail(db.Model):
+    """ Email waiting in the outbox for the mail worker """
+    __tablename__ = 'outbound_mail'
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String, nullable=False)
+    recipients = db.Column(db.String, nullable=False)     # JSON list of addresses
+    html = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime)     # None once sent or given up
+    locked_until = db.Column(db.DateTime)
+    worker = db.Column(db.String)
+    sent_at = db.Column(db.DateTime)
+    last_error = db.Column(db.String)
+
+    __table_args__ = (
+        db.Index('ix_outbound_mail_next_attempt_at', 'next_attempt_at'),
+    )
+
+    def __init__(self, subject, recipients, html):
+        self.subject = subject
+        self.recipients = json.dumps(recipients)
+        self.html = html
+        self.created_at = datetime.now()
+        self.attempts = 0
+        self.next_attempt_at = self.created_at
+
+    @property
+    def recipient_list(self):
+        return [r if isinstance(r, str) else tuple(r) for r in json.loads(self.recipients)]
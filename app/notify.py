@@ -0,0 +1,111 @@
+""" Meeting notifications: changes are held per recipient for NOTIFY_WINDOW seconds, or until
+the daily digest, so that later changes to the same reservation replace earlier ones and
+each recipient gets one message """
+import json
+from datetime import datetime, time, timedelta
+
+from flask import current_app, render_template
+
+from .metrics import metrics
+from .models import db, OutboundMail, PendingNotification, User
+
+
+def merge_kind(first, last):
+    """ Net change of a recipient's first and last change to one reservation, None when
+    they cancel out (invited, then removed before hearing of it) """
+    if first == 'invited':
+        return None if last in ('removed', 'cancelled') else 'invited'
+    if first == 'removed' and last == 'invited':
+        return 'modified'
+    return last
+
+def merge(changes):
+    """ Gets the (subject, message, info) left of one recipient's changes, one per reservation """
+    by_reservation = {}
+    for c in changes:
+        key = c.reservation_id if c.reservation_id is not None else ('change', c.id)
+        by_reservation.setdefault(key, []).append(c)
+
+    merged = []
+    for held in by_reservation.values():
+        first, last = held[0], held[-1]
+        kind = merge_kind(first.kind, last.kind)
+        if kind is None:
+            continue
+        # worded as the change that decided the kind, with the latest details
+        wording = first if kind == first.kind != last.kind else last
+        info = json.loads(last.info)
+        subject = wording.subject
+        if len(held) > 1 and kind in ('invited', 'modified'):
+            # subjects carry the date and time of their own change
+            subject = f'[VRRA] Meeting Updated: <{info.get("subject", "")}>'
+        merged.append((subject, wording.message, info))
+    return merged
+
+def next_digest(now, hour):
+    """ Gets the next time daily digests go out """
+    due = datetime.combine(now.date(), time(hour))
+    return due if due > now else due + timedelta(days=1)
+
+def notify(usernames, kind, subject, message, info, reservation_id=None):
+    """ Holds a change for given users until the mail worker merges and queues it. kind is
+    invited, modified, removed or cancelled, message and info fill mail.html. Caller commits """
+    usernames = set(usernames)
+    if not usernames:
+        return
+
+    now = datetime.now()
+    window = now + timedelta(seconds=current_app.config['NOTIFY_WINDOW'])
+    digest = next_digest(now, current_app.config['DIGEST_HOUR'])
+    info = json.dumps(info, default=str)
+    for u in db.session.query(User.username, User.email, User.notify_digest).filter(User.username.in_(usernames)):
+        db.session.add(PendingNotification(username=u.username, email=u.email, reservation_id=reservation_id,
+            kind=kind, subject=subject, message=message, info=info, created_at=now,
+            due_at=digest if u.notify_digest else window))
+        metrics.notifications.inc(kind)
+
+def flush_notifications(now=None):
+    """ Queues one outbox message per recipient with a change due, carrying all their held
+    changes, recipients of the same content share a message. Gets (changes, messages) """
+    now = now or datetime.now()
+    usernames = [u for u, in db.session.query(PendingNotification.username).filter(
+        PendingNotification.due_at <= now).distinct()]
+    if not usernames:
+        return 0, 0
+
+    # what isn't due yet goes along, it would only be superseded or sent separately later
+    held = db.session.query(PendingNotification).filter(
+        PendingNotification.username.in_(usernames)).order_by(PendingNotification.id).all()
+    removed = db.session.query(PendingNotification).filter(
+        PendingNotification.id.in_([c.id for c in held])).delete(synchronize_session=False)
+    if removed != len(held):
+        # another worker flushed some of them first
+        db.session.rollback()
+        return 0, 0
+
+    by_user = {}
+    for c in held:
+        by_user.setdefault((c.username, c.email), []).append(c)
+    digests = {u for u, in db.session.query(User.username).filter(
+        User.username.in_(usernames), User.notify_digest==True)}
+
+    outbox = {}     # (subject, html) -> addresses
+    for (username, email), changes in by_user.items():
+        merged = merge(changes)
+        if not merged:
+            continue
+        sections = [render_template('mail.html', message=message, info=info) for _, message, info in merged]
+        if len(sections) == 1 and username not in digests:
+            subject, html = merged[0][0], sections[0]
+        else:
+            subject = f'[VRRA] {"Daily digest: " if username in digests else ""}{len(sections)} meeting updates'
+            html = render_template('mail_digest.html', sections=sections, digest=username in digests)
+        outbox.setdefault((subject, html), []).append(email)
+
+    for (subject, html), emails in outbox.items():
+        db.session.add(OutboundMail(subject, emails, html))
+        metrics.mail_queued.inc()
+    db.session.commit()
+
+    metrics.notifications_saved.inc(amount=len(held) - len(outbox))
+    return len(held), len(outbox)
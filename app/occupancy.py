@@ -0,0 +1,111 @@
+""" Per-room, per-day hour occupancy index used for room conflict checks. numpy is imported by the
+functions using it (here, in booking and in analytics) so web workers start without it """
+from datetime import time
+
+from config import OPEN_HOURS
+from .models import db, Reservation, RoomOccupancy
+
+
+def to_hour(t):
+    """ Gets hour integer from a time object or hour integer """
+    if isinstance(t, time):
+        return t.hour
+    return int(t)
+
+def hour_mask(time_start, time_end):
+    """ Bitmask of hours in [time_start, time_end), end of 00:00 means midnight """
+    start = to_hour(time_start)
+    end = to_hour(time_end)
+    end = end if end != 0 else 24
+    if end <= start:
+        return 0
+    return ((1 << end) - 1) & ~((1 << start) - 1)
+
+# only hours inside the opening hours are ever stored
+OPEN_MASK = hour_mask(OPEN_HOURS[0], OPEN_HOURS[1])
+
+def get_occupied(room_id, booked_date):
+    """ Gets the occupied hours bitmask of a room on given date """
+    hours = db.session.query(RoomOccupancy.hours).filter(
+        RoomOccupancy.room_id==room_id,
+        RoomOccupancy.booked_date==booked_date).scalar()
+    return hours or 0
+
+def ensure_row(room_id, booked_date):
+    """ Creates an empty index row if missing, without failing when another worker just did """
+    db.insert_or_ignore(RoomOccupancy.__table__, room_id=room_id, booked_date=booked_date, hours=0)
+
+def claim(room_id, booked_date, mask):
+    """ Atomically takes hours of a room, False if any of them is already taken. Caller commits
+    or rolls back, the conditional UPDATE holds the row until then so concurrent claims serialize """
+    mask &= OPEN_MASK
+    ensure_row(room_id, booked_date)
+    claimed = db.session.query(RoomOccupancy).filter(
+        RoomOccupancy.room_id==room_id,
+        RoomOccupancy.booked_date==booked_date,
+        RoomOccupancy.hours.op('&')(mask)==0).update(
+        {RoomOccupancy.hours: RoomOccupancy.hours.op('|')(mask)}, synchronize_session=False)
+    return claimed == 1
+
+def claim_days(room_id, days, mask):
+    """ claim() for several days of a room in three statements, gets the days whose hours were free.
+    Caller commits or rolls back """
+    mask &= OPEN_MASK
+    db.insert_all_or_ignore(RoomOccupancy.__table__, [{'room_id': room_id, 'booked_date': d, 'hours': 0} for d in days])
+    # the insert holds sqlite's write lock, other databases lock the rows read here
+    taken = {o.booked_date for o in db.session.query(RoomOccupancy.booked_date).filter(
+        RoomOccupancy.room_id==room_id,
+        RoomOccupancy.booked_date.in_(days),
+        RoomOccupancy.hours.op('&')(mask)!=0).with_for_update()}
+    free = [d for d in days if d not in taken]
+    if free:
+        db.session.query(RoomOccupancy).filter(
+            RoomOccupancy.room_id==room_id,
+            RoomOccupancy.booked_date.in_(free)).update(
+            {RoomOccupancy.hours: RoomOccupancy.hours.op('|')(mask)}, synchronize_session=False)
+    return free
+
+def release(room_id, booked_date, mask):
+    """ Marks hours as free again, caller commits """
+    db.session.query(RoomOccupancy).filter(
+        RoomOccupancy.room_id==room_id,
+        RoomOccupancy.booked_date==booked_date).update(
+        {RoomOccupancy.hours: RoomOccupancy.hours.op('&')(~mask)}, synchronize_session=False)
+
+def rebuild_occupancy():
+    """ Rebuilds the whole index from reservations """
+    db.session.query(RoomOccupancy).delete()
+
+    index = {}
+    for r in db.session.query(Reservation.room_id, Reservation.booked_date, Reservation.time_start, Reservation.time_end).all():
+        key = (r.room_id, r.booked_date)
+        index[key] = index.get(key, 0) | hour_mask(r.time_start, r.time_end)
+
+    db.session.add_all(RoomOccupancy(k[0], k[1], v & OPEN_MASK) for k, v in index.items())
+    db.session.commit()
+    return len(index)
+
+def occupancy_grid(start, end, rooms):
+    """ Boolean array of rooms x days x open hours between start and end (inclusive), one query """
+    import numpy as np
+    days = (end - start).days + 1
+    row = {room_id: i for i, room_id in enumerate(rooms)}
+    masks = np.zeros((len(rooms), days), dtype=np.int64)
+
+    for o in db.session.query(RoomOccupancy.room_id, RoomOccupancy.booked_date, RoomOccupancy.hours).filter(
+            RoomOccupancy.booked_date >= start, RoomOccupancy.booked_date <= end,
+            RoomOccupancy.room_id.in_(rooms)).all():
+        masks[row[o.room_id], (o.booked_date - start).days] = o.hours
+
+    hours = np.arange(OPEN_HOURS[0], OPEN_HOURS[1])
+    return ((masks[:, :, None] >> hours) & 1).astype(bool)
+
+def grid_ranges(grid):
+    """ Run-length encodes a rooms x days x hours grid into (room, day, start, end) index rows """
+    import numpy as np
+    padded = np.pad(grid, ((0, 0), (0, 0), (1, 1))).astype(np.int8)
+    edges = np.diff(padded, axis=2)
+    # rising and falling edges come out in the same row-major order
+    starts = np.argwhere(edges == 1)
+    ends = np.argwhere(edges == -1)
+    return np.column_stack((starts, ends[:, 2]))
@@ -0,0 +1,36 @@
+""" Keyset (cursor) pagination of reservation listings on (booked_date, time_start, id) """
+import base64
+import json
+from datetime import date, time
+
+from sqlalchemy import tuple_
+
+
+def encode_cursor(booked_date, time_start, id):
+    """ Opaque token for the position after given row """
+    key = json.dumps([booked_date.isoformat(), time_start.isoformat(), id])
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """ Gets (booked_date, time_start, id) back from a token, raises ValueError when malformed """
+    try:
+        booked_date, time_start, id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return date.fromisoformat(booked_date), time.fromisoformat(time_start), int(id)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f'Invalid cursor {cursor!r}') from e
+
+def keyset_page(query, keys, cursor=None, per_page=50, desc=False):
+    """ Gets (rows, next cursor) of one page. keys are the (booked_date, time_start, id)
+    columns the query is ordered by, named as on the rows, next cursor is None on the last page """
+    position = tuple_(*keys)
+    if cursor:
+        after = tuple_(*decode_cursor(cursor))
+        query = query.filter(position < after if desc else position > after)
+    query = query.order_by(*(k.desc() if desc else k for k in keys))
+
+    # one extra row tells whether there is a next page
+    rows = query.limit(per_page + 1).all()
+    if len(rows) <= per_page:
+        return rows, None
+    rows = rows[:per_page]
+    return rows, encode_cursor(*(getattr(rows[-1], k.key) for k in keys))
@@ -0,0 +1,120 @@
+""" Room inventory: attribute search, pages of rooms and per-room opening hours """
+import json
+
+from flask import current_app, request
+from sqlalchemy import text
+from werkzeug.exceptions import abort
+
+from config import NO_OF_ROOMS
+from .cache import cache
+from .models import db, Reservation, Room, RoomEquipment
+from .occupancy import OPEN_MASK, hour_mask
+
+# bumped when rooms are added or changed
+ROOMS_KEY = 'rooms'
+# what pages of rooms load, equipment comes with the selectin relationship
+ROOM_COLUMNS = (Room.id, Room.name, Room.site, Room.capacity, Room.open_hour, Room.close_hour)
+
+
+def open_mask(room):
+    """ Bitmask of the hours a room (or a row with its open_hour and close_hour) can be booked """
+    return hour_mask(room.open_hour, room.close_hour) & OPEN_MASK
+
+def opening_hours(room):
+    return f'{room.open_hour:02d}:00 - {room.close_hour % 24:02d}:00'
+
+def room_label(room):
+    """ Name, site and size of a room for choices and table headers """
+    details = [d for d in (room.site, f'{room.capacity} seats' if room.capacity else '') if d]
+    return f'{room.name} ({", ".join(details)})' if details else room.name
+
+def search_rooms(site=None, capacity=None, equipment=()):
+    """ Query of the rooms at site seating at least capacity with every equipment item """
+    query = db.session.query(Room)
+    if site:
+        query = query.filter(Room.site==site)
+    if capacity:
+        query = query.filter(Room.capacity>=capacity)
+    for item in equipment:
+        query = query.filter(Room.id.in_(db.session.query(RoomEquipment.room_id).filter(RoomEquipment.item==item)))
+    return query
+
+def room_page(query, after=None, per_page=20):
+    """ Gets (rooms, id to continue after or None) of the rooms of a query following room id after """
+    if after is not None:
+        query = query.filter(Room.id > after)
+    rooms = query.order_by(Room.id).limit(per_page + 1).all()
+    if len(rooms) <= per_page:
+        return rooms, None
+    return rooms[:per_page], rooms[per_page - 1].id
+
+def request_rooms():
+    """ Page of the rooms matching the site, capacity and equipment arguments of the request,
+    after the after argument. Gets (rooms, next after, filters) """
+    try:
+        capacity = int(request.args['capacity']) if request.args.get('capacity') else None
+        after = int(request.args['after']) if request.args.get('after') else None
+        per_page = int(request.args.get('rooms_per_page', current_app.config['ROOM_PAGE_SIZE']))
+    except ValueError:
+        abort(400)
+    if per_page < 1 or per_page > current_app.config['PAGE_SIZE_MAX'] or (capacity is not None and capacity < 0):
+        abort(400)
+
+    site = request.args.get('site') or None
+    # repeated or comma separated
+    equipment = sorted({e.strip() for v in request.args.getlist('equipment') for e in v.split(',') if e.strip()})
+    rooms, next_after = room_page(search_rooms(site, capacity, equipment), after, per_page)
+
+    filters = {'site': site, 'capacity': capacity, 'equipment': ','.join(equipment) or None,
+        'rooms_per_page': request.args.get('rooms_per_page')}
+    return rooms, next_after, {k: v for k, v in filters.items() if v is not None}
+
+def get_rooms(ids):
+    """ room id -> (id, name, site, capacity, open_hour, close_hour) row of the given ids """
+    if not ids:
+        return {}
+    return {r.id: r for r in db.session.query(*ROOM_COLUMNS).filter(Room.id.in_(ids))}
+
+def get_sites():
+    """ Every site, for filter choices, read again only after rooms changed """
+    version = cache.current(ROOMS_KEY)
+    sites = cache.get(ROOMS_KEY, version)
+    if sites is None:
+        sites = json.dumps([s for s, in db.session.query(Room.site).distinct().order_by(Room.site)])
+        cache.set(ROOMS_KEY, version, sites)
+    return json.loads(sites)
+
+def invalidate_rooms():
+    """ Called after rooms are created or changed """
+    cache.bump(ROOMS_KEY)
+
+def check_room(room_id, time_start, time_end):
+    """ Checks that a room exists and is open for the whole slot, gets the error or '' """
+    room = get_rooms([room_id]).get(room_id)
+    if room is None:
+        return f'Room {room_id} does not exist'
+    mask = hour_mask(time_start, time_end)
+    if not mask:
+        return f'{time_start} - {time_end} ends before it starts'
+    if mask & ~open_mask(room):
+        return f'{room.name} is only open {opening_hours(room)}'
+    return ''
+
+def ensure_rooms():
+    """ Creates Room 1 to NO_OF_ROOMS in an empty room table and a room for every room id
+    reservations refer to without one, gets the number created """
+    ids = set() if db.session.query(Room.id).first() else set(range(1, NO_OF_ROOMS + 1))
+    ids |= {id for id, in db.session.query(Reservation.room_id).distinct()}
+    ids -= set(get_rooms(ids))
+
+    for id in sorted(ids):
+        room = Room(f'Room {id}')
+        room.id = id
+        db.session.add(room)
+    db.session.flush()
+    if ids and db.engine.dialect.name == 'postgresql':
+        # explicit ids don't move the sequence, the next add-room would collide
+        db.session.execute(text("SELECT setval(pg_get_serial_sequence('room', 'id'), (SELECT max(id) FROM room))"))
+    db.session.commit()
+    invalidate_rooms()
+    return len(ids)
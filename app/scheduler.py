@@ -0,0 +1,118 @@
+""" Reminder scheduler, runs as its own process (flask run-scheduler) """
+import heapq
+import time as systime
+from datetime import date, datetime, time, timedelta
+
+from flask import render_template
+
+from .models import db, Reservation, ReservationParticipant, User
+from .mail import send_msg
+
+# reminders used to go out once (booked_date - today).days <= 1,
+# i.e. from midnight two days before the meeting
+REMINDER_LEAD = timedelta(days=2)
+# reservations committed slightly out of updated_at order are still picked up
+LOAD_OVERLAP = timedelta(minutes=1)
+
+def reminder_due(booked_date):
+    """ Gets the time a reservation's reminder should be sent """
+    return datetime.combine(booked_date, time()) - REMINDER_LEAD
+
+class ReminderScheduler(object):
+    """ Keeps a due-time priority queue of reminders, loaded incrementally """
+
+    def __init__(self, batch_size=100):
+        self.batch_size = batch_size
+        self.queue = []         # heap of (due, reservation id, updated_at)
+        self.pending = {}       # reservation id -> updated_at of its live queue entry
+        self.watermark = None
+
+    def load(self):
+        """ Queues reservations created or edited since the last load. Past ones never get their
+        reminder and keep reminder unset, so they are left out """
+        query = db.session.query(Reservation.id, Reservation.booked_date, Reservation.updated_at).filter(
+            Reservation.reminder==False, Reservation.booked_date >= date.today())
+        if self.watermark is not None:
+            query = query.filter(Reservation.updated_at >= self.watermark - LOAD_OVERLAP)
+
+        loaded = 0
+        for r in query.order_by(Reservation.updated_at):
+            if self.pending.get(r.id) == r.updated_at:
+                continue
+            # an older entry for an edited reservation stays in the heap but is skipped
+            self.pending[r.id] = r.updated_at
+            heapq.heappush(self.queue, (reminder_due(r.booked_date), r.id, r.updated_at))
+            if r.updated_at is not None:
+                self.watermark = r.updated_at
+            loaded += 1
+        return loaded
+
+    def pop_due(self, now):
+        """ Pops ids of live reminders due at given time """
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            _, id, updated_at = heapq.heappop(self.queue)
+            if id in self.pending and self.pending[id] == updated_at:
+                del self.pending[id]
+                due.append(id)
+        return due
+
+    def next_due(self):
+        return self.queue[0][0] if self.queue else None
+
+    def fire(self, now=None):
+        """ Sends all due reminders in batches, returns number sent """
+        due = self.pop_due(now or datetime.now())
+        sent = 0
+        for i in range(0, len(due), self.batch_size):
+            sent += send_reminders(due[i:i + self.batch_size])
+        return sent
+
+    def run(self, poll_interval=30, stopping=None):
+        """ Loads and fires until stopping is set """
+        while stopping is None or not stopping.is_set():
+            self.load()
+            self.fire()
+            db.session.remove()
+
+            wait = poll_interval
+            if self.next_due() is not None:
+                wait = min(wait, max((self.next_due() - datetime.now()).total_seconds(), 0))
+            if stopping is None:
+                systime.sleep(wait)
+            else:
+                stopping.wait(wait)
+
+def send_reminders(ids):
+    """ Queues reminder emails for given reservations, one commit for the batch """
+    reservations = db.session.query(Reservation).filter(
+        Reservation.id.in_(ids), Reservation.reminder==False, Reservation.status==0).all()
+    if not reservations:
+        return 0
+
+    hosts = dict(db.session.query(User.username, User.name).filter(
+        User.username.in_({r.username for r in reservations})).all())
+
+    emails = {}
+    for p in db.session.query(ReservationParticipant.reservation_id, User.username, User.email).join(
+            User, User.username==ReservationParticipant.username).filter(
+            ReservationParticipant.reservation_id.in_([r.id for r in reservations])).all():
+        emails.setdefault(p.reservation_id, []).append((p.username, p.email))
+
+    for r in reservations:
+        info = {
+            'subject':r.subject,
+            'date':r.booked_date,
+            'time_start':r.time_start,
+            'time_end':r.time_end,
+            'party':r.party,
+            'host': (hosts.get(r.username, r.username), r.username),
+            'message':r.message
+            }
+        reminder_html = render_template('mail.html', message='The meeting you\'re in is coming soon.', info=info)
+        send_msg(f'[VRRA] Meeting Reminder: <{info["subject"]}> ', emails.get(r.id, []), reminder_html, commit=False)
+
+    db.session.query(Reservation).filter(Reservation.id.in_([r.id for r in reservations])).update(
+        dict(reminder=True), synchronize_session=False)
+    db.session.commit()
+    return len(reservations)
@@ -0,0 +1,136 @@
+""" Synthetic users and reservations for benchmarks and load tests (flask seed-db) """
+import random
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import func
+from werkzeug.security import generate_password_hash
+
+from .hashing import hasher
+from .models import db, format_party, Reservation, ReservationParticipant, Room, User
+from .occupancy import hour_mask, rebuild_occupancy
+from .rooms import ensure_rooms, invalidate_rooms
+from .usage import rebuild_usage
+
+SEED_PASSWORD = 'password'
+SUBJECTS = ('Standup', 'Planning', 'Retro', '1:1', 'Design review', 'Interview', 'Demo', 'Sync', 'Workshop')
+FIRST_NAMES = ('Ana', 'Ben', 'Chen', 'Dita', 'Eko', 'Fay', 'Gus', 'Hana', 'Ivan', 'Jia', 'Kai', 'Lina')
+LAST_NAMES = ('Wijaya', 'Lee', 'Santoso', 'Park', 'Tan', 'Ng', 'Smith', 'Lim', 'Chua', 'Kusuma')
+SITES = ('Jakarta', 'Bandung', 'Surabaya', 'Singapore', 'Kuala Lumpur')
+CAPACITIES = (2, 4, 4, 6, 8, 8, 12, 20, 40)
+EQUIPMENT = ('projector', 'whiteboard', 'video', 'phone', 'tv')
+
+
+def seed_users(count, rng):
+    """ Adds count users seedNNNNN with a shared password, gets all seeded (username, name) """
+    # hashing is slow on purpose, every seeded user shares the one hash
+    password = generate_password_hash(SEED_PASSWORD, hasher.method)
+    taken = {u for u, in db.session.query(User.username).filter(User.username.like('seed%'))}
+
+    n = 0
+    while count > 0:
+        username = f'seed{n:05d}'
+        if username not in taken:
+            name = f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+            db.session.add(User(username, name, f'{username}@example.com', password))
+            count -= 1
+        n += 1
+    db.session.commit()
+    return [tuple(u) for u in db.session.query(User.username, User.name).filter(User.username.like('seed%')).all()]
+
+def seed_rooms(count, rng):
+    """ Adds count rooms spread over SITES with random sizes, equipment and opening hours """
+    # numbering continues after earlier seeded rooms
+    first = db.session.query(func.count(Room.id)).scalar()
+    for n in range(first, first + count):
+        site = SITES[n % len(SITES)]
+        # most rooms keep office hours, some close early
+        close_hour = rng.choice((24, 24, 24, 20, 18))
+        db.session.add(Room(f'{site[:3].upper()}-{n // len(SITES) + 1:04d}', site, rng.choice(CAPACITIES),
+            close_hour=close_hour, equipment=rng.sample(EQUIPMENT, rng.randint(0, 3))))
+    db.session.commit()
+    invalidate_rooms()
+
+def seed_reservations(count, days, users, rng, batch_size=5000):
+    """ Adds up to count non-conflicting reservations spread over days around today,
+    gets the number added. Goes through Core inserts, so ids are handed out here """
+    today = date.today()
+    first_day = today - timedelta(days=days // 2)
+    rooms = {}      # (room_id, date) -> taken hours
+    busy = {}       # (username, date) -> taken hours
+
+    # earlier reservations in the window, seeded or not, stay conflict free
+    for r in db.session.query(ReservationParticipant.username, Reservation.room_id, Reservation.booked_date,
+            Reservation.time_start, Reservation.time_end).join(
+            ReservationParticipant, ReservationParticipant.reservation_id==Reservation.id).filter(
+            Reservation.booked_date >= first_day, Reservation.booked_date < first_day + timedelta(days=days)):
+        mask = hour_mask(r.time_start, r.time_end)
+        rooms[(r.room_id, r.booked_date)] = rooms.get((r.room_id, r.booked_date), 0) | mask
+        busy[(r.username, r.booked_date)] = busy.get((r.username, r.booked_date), 0) | mask
+    next_id = (db.session.query(func.max(Reservation.id)).scalar() or 0) + 1
+    inventory = db.session.query(Room.id, Room.open_hour, Room.close_hour).order_by(Room.id).all()
+
+    rows, participants = [], []
+    added = attempts = 0
+    while added < count and attempts < count * 10:
+        attempts += 1
+        booked_date = first_day + timedelta(days=rng.randrange(days))
+        room_id, open_hour, close_hour = rng.choice(inventory)
+        duration = rng.choice((1, 1, 1, 2, 2, 3))
+        if close_hour - duration < open_hour:
+            continue
+        start = rng.randint(open_hour, max(open_hour, min(close_hour - duration, 19)))
+        mask = hour_mask(start, start + duration)
+        party = [users[0]] if len(users) == 1 else rng.sample(users, min(len(users), rng.randint(2, 5)))
+
+        if rooms.get((room_id, booked_date), 0) & mask or any(busy.get((p[0], booked_date), 0) & mask for p in party):
+            continue
+        rooms[(room_id, booked_date)] = rooms.get((room_id, booked_date), 0) | mask
+        for p in party:
+            busy[(p[0], booked_date)] = busy.get((p[0], booked_date), 0) | mask
+
+        booking_time = datetime.combine(booked_date - timedelta(days=rng.randint(1, 30)), time(rng.randint(8, 18)))
+        past = booked_date < today
+        rows.append({
+            'id': next_id,
+            'username': party[0][0],
+            'subject': rng.choice(SUBJECTS),
+            'room_id': room_id,
+            'booking_time': booking_time,
+            'booked_date': booked_date,
+            'time_start': time(start),
+            'time_end': time(start + duration),
+            '_party': format_party(party),
+            'message': '',
+            'reminder': past,
+            'updated_at': booking_time,
+            'status': 2 if past else 0,
+            })
+        participants.extend({'reservation_id': next_id, 'username': p[0], 'booked_date': booked_date} for p in party)
+        next_id += 1
+        added += 1
+
+        if len(rows) >= batch_size:
+            flush_rows(rows, participants)
+            rows, participants = [], []
+
+    flush_rows(rows, participants)
+    rebuild_occupancy()
+    rebuild_usage()
+    return added
+
+def flush_rows(rows, participants):
+    if rows:
+        db.session.execute(Reservation.__table__.insert(), rows)
+        db.session.execute(ReservationParticipant.__table__.insert(), participants)
+        db.session.commit()
+
+def seed_database(users=50, reservations=1000, days=60, seed=0, rooms=0):
+    """ Seeds rooms and users, then reservations among all seeded users in all rooms,
+    gets (users, reservations) added """
+    rng = random.Random(seed)
+    ensure_rooms()
+    seed_rooms(rooms, rng)
+    party = seed_users(users, rng)
+    if not party:
+        return 0, 0
+    return users, seed_reservations(reservations, days, party, rng)
@@ -0,0 +1,66 @@
+""" Earliest common free slot search across rooms and participants """
+from datetime import datetime, timedelta
+
+from config import OPEN_HOURS
+from .models import db, Reservation, ReservationParticipant, RoomOccupancy
+from .occupancy import hour_mask
+
+
+def party_busy(usernames, start, end, exclude=None):
+    """ Busy hours bitmask per date for any of given users, one query for the window """
+    query = db.session.query(ReservationParticipant.booked_date, Reservation.time_start, Reservation.time_end).join(
+        Reservation, Reservation.id==ReservationParticipant.reservation_id).filter(
+        ReservationParticipant.username.in_(usernames),
+        ReservationParticipant.booked_date >= start, ReservationParticipant.booked_date <= end)
+    if exclude is not None:
+        query = query.filter(ReservationParticipant.reservation_id!=exclude)
+
+    busy = {}
+    for r in query.all():
+        busy[r.booked_date] = busy.get(r.booked_date, 0) | hour_mask(r.time_start, r.time_end)
+    return busy
+
+def room_busy(rooms, start, end, exclude=None):
+    """ Occupied hours bitmask per (room, date), one query for the window """
+    busy = {(o.room_id, o.booked_date): o.hours for o in db.session.query(
+        RoomOccupancy.room_id, RoomOccupancy.booked_date, RoomOccupancy.hours).filter(
+        RoomOccupancy.room_id.in_(rooms),
+        RoomOccupancy.booked_date >= start, RoomOccupancy.booked_date <= end).all()}
+
+    if exclude is not None:
+        # hours of the reservation being edited are free for itself
+        r = db.session.query(Reservation.room_id, Reservation.booked_date, Reservation.time_start, Reservation.time_end).filter(
+            Reservation.id==exclude).first()
+        if r and (r.room_id, r.booked_date) in busy:
+            busy[(r.room_id, r.booked_date)] &= ~hour_mask(r.time_start, r.time_end)
+    return busy
+
+def find_slots(usernames, duration, start, end, rooms, k=5, exclude=None, now=None, open_masks=None):
+    """ Gets the k earliest (date, hour, room) where the whole party and a room are free.
+    open_masks maps room ids to the hours they open, rooms without one are open all OPEN_HOURS """
+    now = now or datetime.now()
+    parties = party_busy(usernames, start, end, exclude)
+    occupied = room_busy(rooms, start, end, exclude)
+    # closed hours count as taken
+    closed = {room_id: ~mask for room_id, mask in (open_masks or {}).items()}
+
+    slots = []
+    day = start
+    while day <= end and len(slots) < k:
+        first = OPEN_HOURS[0]
+        if day == now.date():
+            first = max(first, now.hour + 1)
+        elif day < now.date():
+            first = OPEN_HOURS[1]
+
+        for hour in range(first, OPEN_HOURS[1] - duration + 1):
+            mask = hour_mask(hour, hour + duration)
+            if parties.get(day, 0) & mask:
+                continue
+            for room_id in rooms:
+                if not (occupied.get((room_id, day), 0) | closed.get(room_id, 0)) & mask:
+                    slots.append((day, hour, room_id))
+                    if len(slots) == k:
+                        return slots
+        day += timedelta(days=1)
+    return slots
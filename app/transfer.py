@@ -0,0 +1,378 @@
+""" Streaming bulk import and export of reservations as CSV or iCalendar
+(flask import-reservations / export-reservations) """
+import csv
+from datetime import date, datetime, time, timezone
+
+from sqlalchemy import tuple_
+
+from .cache import cache
+from .changes import record_change
+from .models import db, format_party, Reservation, ReservationParticipant, RoomOccupancy, User
+from .occupancy import claim, hour_mask
+from .rooms import get_rooms, open_mask, opening_hours
+from .usage import add_usage, invalidate_usage, seat_hours
+
+CSV_FIELDS = ('username', 'subject', 'room_id', 'booked_date', 'time_start', 'time_end', 'party', 'message', 'booking_time')
+REJECT_FIELDS = ('line', 'error') + CSV_FIELDS
+ICS_DATETIME = '%Y%m%dT%H%M%S'
+
+
+class ImportStats(object):
+    def __init__(self):
+        self.imported = 0
+        self.rejected = 0
+        self.batches = 0
+
+def load_users():
+    """ username -> (name, email) of every user, the directory is small next to the reservations """
+    return {u.username: (u.name, u.email) for u in db.session.query(User.username, User.name, User.email)}
+
+# Parsing, both formats yield (line number, fields as strings or None, error or None)
+def read_csv(f):
+    reader = csv.DictReader(f)
+    missing = {'username', 'room_id', 'booked_date', 'time_start', 'time_end'} - set(reader.fieldnames or ())
+    if missing:
+        raise ValueError(f'CSV header lacks {", ".join(sorted(missing))}')
+    for row in reader:
+        yield reader.line_num, {k: (row.get(k) or '').strip() for k in CSV_FIELDS}, None
+
+def unfold(f):
+    """ Joins folded iCalendar lines, yields (line number, content line) """
+    pending, start = None, 0
+    for n, line in enumerate(f, 1):
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and pending is not None:
+            pending += line[1:]
+            continue
+        if pending:
+            yield start, pending
+        pending, start = line, n
+    if pending:
+        yield start, pending
+
+def split_content_line(line):
+    """ Gets (NAME, {PARAM: value}, value) of a content line, colons in quoted parameters are kept """
+    quoted = False
+    for i, ch in enumerate(line):
+        if ch == '"':
+            quoted = not quoted
+        elif ch == ':' and not quoted:
+            break
+    else:
+        i = len(line)
+    name, *params = line[:i].split(';')
+    params = dict(p.split('=', 1) for p in params if '=' in p)
+    return name.upper(), {k.upper(): v.strip('"') for k, v in params.items()}, line[i + 1:]
+
+def unescape(value):
+    return value.replace('\\n', '\n').replace('\\N', '\n').replace('\\,', ',').replace('\\;', ';').replace('\\\\', '\\')
+
+def parse_ics_datetime(value, params):
+    if params.get('VALUE') == 'DATE' or 'T' not in value:
+        raise ValueError('all-day events are not reservations')
+    if value.endswith('Z'):
+        # UTC, stored reservations are in local time
+        return datetime.strptime(value[:-1], ICS_DATETIME).replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+    return datetime.strptime(value, ICS_DATETIME)
+
+def read_ics(f, users):
+    """ Turns VEVENTs into import fields, attendees and organizer are matched by email """
+    by_email = {email.lower(): username for username, (_, email) in users.items()}
+    event = None
+    for n, line in unfold(f):
+        name, params, value = split_content_line(line)
+
+        if name == 'BEGIN' and value.upper() == 'VEVENT':
+            event = {'line': n, 'attendees': []}
+        elif name == 'END' and value.upper() == 'VEVENT' and event is not None:
+            yield event_fields(event, by_email)
+            event = None
+        elif event is not None:
+            if name == 'ATTENDEE':
+                event['attendees'].append(value)
+            else:
+                event[name] = (value, params)
+
+def event_fields(event, by_email):
+    n = event['line']
+    try:
+        start = parse_ics_datetime(*event['DTSTART'])
+        end = parse_ics_datetime(*event['DTEND'])
+    except KeyError:
+        return n, None, 'event lacks DTSTART or DTEND'
+    except ValueError as e:
+        return n, None, str(e)
+    # ending at the next midnight is the only way to leave the day
+    if end.date() != start.date() and (end.time() != time() or (end.date() - start.date()).days != 1):
+        return n, None, 'event spans more than a day'
+
+    host = event.get('X-VRRA-HOST', ('', {}))[0]
+    if not host and 'ORGANIZER' in event:
+        host = by_email.get(event['ORGANIZER'][0].lower().replace('mailto:', ''), '')
+    room = event.get('X-VRRA-ROOM', ('', {}))[0] or event.get('LOCATION', ('', {}))[0].replace('Room', '').strip()
+
+    party = []
+    for attendee in event['attendees']:
+        email = attendee.lower().replace('mailto:', '')
+        if email not in by_email:
+            return n, None, f'unknown attendee {email}'
+        party.append(by_email[email])
+
+    stamp = event.get('DTSTAMP')
+    return n, {
+        'username': host,
+        'subject': unescape(event.get('SUMMARY', ('', {}))[0]),
+        'room_id': room,
+        'booked_date': start.date().isoformat(),
+        'time_start': start.strftime('%H:%M'),
+        'time_end': end.strftime('%H:%M'),
+        'party': ';'.join(party),
+        'message': unescape(event.get('DESCRIPTION', ('', {}))[0]),
+        'booking_time': parse_ics_datetime(*stamp).isoformat() if stamp else '',
+        }, None
+
+# Validation
+def to_row(fields, users, rooms, now):
+    """ Gets the reservation values of import fields, raises ValueError with the reason """
+    username = fields['username']
+    if username not in users:
+        raise ValueError(f'unknown user {username!r}')
+    party = [p.strip() for p in fields['party'].split(';') if p.strip()]
+    unknown = [p for p in party if p not in users]
+    if unknown:
+        raise ValueError(f'unknown participants {", ".join(unknown)}')
+    # the host always takes part
+    party = [username] + [p for p in dict.fromkeys(party) if p != username]
+
+    room_id = int(fields['room_id'])
+    if room_id not in rooms:
+        raise ValueError(f'no room {room_id}')
+    booked_date = date.fromisoformat(fields['booked_date'])
+    time_start = time.fromisoformat(fields['time_start'])
+    time_end = time.fromisoformat(fields['time_end'])
+    if time_start.minute or time_end.minute:
+        raise ValueError('reservations start and end on the hour')
+    mask = hour_mask(time_start, time_end)
+    if not mask or mask & ~open_mask(rooms[room_id]):
+        raise ValueError(f'{time_start} - {time_end} is outside the opening hours {opening_hours(rooms[room_id])} of room {room_id}')
+
+    booking_time = datetime.fromisoformat(fields['booking_time']) if fields['booking_time'] else now
+    past = booked_date < now.date()
+    return {
+        'username': username,
+        'subject': fields['subject'] or 'Meeting',
+        'room_id': room_id,
+        'booking_time': booking_time,
+        'booked_date': booked_date,
+        'time_start': time_start,
+        'time_end': time_end,
+        '_party': format_party((p, users[p][0]) for p in party),
+        'message': fields['message'],
+        # past and same-day meetings get no reminder
+        'reminder': booked_date <= now.date(),
+        'updated_at': now,
+        'status': 2 if past else 0,
+        }, party, mask
+
+def import_batch(batch, users, reject, stats):
+    """ Validates a batch against stored reservations and itself with one query per table,
+    inserts what fits and commits once """
+    now = datetime.now()
+    room_ids = set()
+    for _, fields in batch:
+        try:
+            room_ids.add(int(fields['room_id']))
+        except (TypeError, ValueError):
+            pass    # rejected by to_row
+    rooms = get_rooms(room_ids)
+
+    parsed = []
+    for n, fields in batch:
+        try:
+            parsed.append((n, fields) + to_row(fields, users, rooms, now))
+        except (TypeError, ValueError) as e:
+            reject(n, fields, str(e))
+    if not parsed:
+        return
+
+    dates = {p[2]['booked_date'] for p in parsed}
+    rooms = {(o.room_id, o.booked_date): o.hours for o in db.session.query(
+        RoomOccupancy.room_id, RoomOccupancy.booked_date, RoomOccupancy.hours).filter(
+        RoomOccupancy.booked_date.in_(dates))}
+    busy = {}
+    for b in db.session.query(ReservationParticipant.username, ReservationParticipant.booked_date,
+            Reservation.time_start, Reservation.time_end).join(
+            Reservation, Reservation.id==ReservationParticipant.reservation_id).filter(
+            ReservationParticipant.booked_date.in_(dates),
+            ReservationParticipant.username.in_({u for p in parsed for u in p[3]})):
+        key = (b.username, b.booked_date)
+        busy[key] = busy.get(key, 0) | hour_mask(b.time_start, b.time_end)
+
+    accepted = {}   # (room_id, date) -> rows taking hours of that room-day
+    for n, fields, row, party, mask in parsed:
+        day = row['booked_date']
+        room_day = (row['room_id'], day)
+        if rooms.get(room_day, 0) & mask:
+            reject(n, fields, f'room {row["room_id"]} is taken on {day} at {row["time_start"]} - {row["time_end"]}')
+            continue
+        clash = next((u for u in party if busy.get((u, day), 0) & mask), None)
+        if clash:
+            reject(n, fields, f'{clash} is busy on {day} at {row["time_start"]} - {row["time_end"]}')
+            continue
+
+        rooms[room_day] = rooms.get(room_day, 0) | mask
+        for u in party:
+            busy[(u, day)] = busy.get((u, day), 0) | mask
+        accepted.setdefault(room_day, []).append((n, fields, row, party, mask))
+
+    claimed = []
+    for (room_id, day), rows in accepted.items():
+        # one claim per room-day, a booking made while importing makes it fail
+        if claim(room_id, day, sum(r[4] for r in rows)):
+            claimed.extend(rows)
+            add_usage(room_id, day, sum(r[4] for r in rows), sum(seat_hours(r[4], len(r[3])) for r in rows), len(rows))
+        else:
+            for n, fields, *_ in rows:
+                reject(n, fields, f'room {room_id} was booked on {day} during the import')
+
+    if claimed:
+        # after the claims, so they hold sqlite's write lock
+        db.insert_all(Reservation.__table__, [r[2] for r in claimed])
+
+    participants = [{'reservation_id': row['id'], 'username': u, 'booked_date': row['booked_date']}
+        for _, _, row, party, _ in claimed for u in party]
+    if participants:
+        db.session.execute(ReservationParticipant.__table__.insert(), participants)
+        # subscribed calendars pick the batch up on their next sync
+        record_change([r[2]['id'] for r in claimed], {p['username'] for p in participants})
+    stats.imported += len(claimed)
+    db.session.commit()
+    stats.batches += 1
+    for day in {day for _, day in accepted}:
+        cache.bump(f'status:{day.isoformat()}')
+    if claimed:
+        invalidate_usage()
+
+def import_reservations(f, fmt, reject_file, batch_size=5000):
+    """ Imports reservations from an open CSV or iCalendar file, rejected rows are written
+    to reject_file with the reason. Gets ImportStats """
+    users = load_users()
+    stats = ImportStats()
+    writer = csv.DictWriter(reject_file, REJECT_FIELDS)
+    writer.writeheader()
+
+    def reject(n, fields, error):
+        stats.rejected += 1
+        writer.writerow(dict(fields or {}, line=n, error=error))
+
+    rows = read_csv(f) if fmt == 'csv' else read_ics(f, users)
+    batch = []
+    for n, fields, error in rows:
+        if error:
+            reject(n, fields, error)
+            continue
+        batch.append((n, fields))
+        if len(batch) >= batch_size:
+            import_batch(batch, users, reject, stats)
+            batch = []
+    import_batch(batch, users, reject, stats)
+    return stats
+
+# Export
+def export_query(start=None, end=None):
+    query = db.session.query(Reservation.id, Reservation.username, Reservation.subject, Reservation.room_id,
+        Reservation.booking_time, Reservation.booked_date, Reservation.time_start, Reservation.time_end,
+        Reservation._party, Reservation.message)
+    if start:
+        query = query.filter(Reservation.booked_date>=start)
+    if end:
+        query = query.filter(Reservation.booked_date<=end)
+    return query.order_by(Reservation.booked_date, Reservation.time_start, Reservation.id)
+
+def stream(query, batch_size):
+    """ Walks a (booked_date, time_start, id) ordered query in keyset pages, memory stays bounded """
+    last = None
+    while True:
+        page = query
+        if last is not None:
+            page = page.filter(tuple_(Reservation.booked_date, Reservation.time_start, Reservation.id) > last)
+        rows = page.limit(batch_size).all()
+        if not rows:
+            return
+        yield from rows
+        last = tuple_(rows[-1].booked_date, rows[-1].time_start, rows[-1].id)
+
+def party_usernames(party):
+    # each entry is stored as 'username, name'
+    return [p.split(',')[0].strip() for p in (party or '').split(';') if p]
+
+def export_csv(out, start=None, end=None, batch_size=5000):
+    writer = csv.writer(out)
+    writer.writerow(CSV_FIELDS)
+    count = 0
+    for r in stream(export_query(start, end), batch_size):
+        writer.writerow((r.username, r.subject, r.room_id, r.booked_date.isoformat(), r.time_start.strftime('%H:%M'),
+            r.time_end.strftime('%H:%M'), ';'.join(party_usernames(r._party)), r.message or '', r.booking_time.isoformat()))
+        count += 1
+    return count
+
+def escape(value):
+    return (value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def quote(value):
+    """ Parameter value, quoted since names may hold commas or colons """
+    return '"' + value.replace('"', "'") + '"'
+
+def fold(line):
+    """ Splits content lines longer than 75 octets as RFC 5545 asks """
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line + '\r\n'
+    parts, current = [], b''
+    for ch in line:
+        b = ch.encode()
+        if len(current) + len(b) > (75 if not parts else 74):
+            parts.append(current.decode())
+            current = b''
+        current += b
+    parts.append(current.decode())
+    return '\r\n '.join(parts) + '\r\n'
+
+ICS_HEADER = 'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//VRRA//Room Reservation//EN\r\n'
+
+def vevent(r, users, extra=()):
+    """ Folded VEVENT of a reservation row, users maps username -> (name, email) """
+    begin = datetime.combine(r.booked_date, r.time_start)
+    finish = datetime.combine(r.booked_date, r.time_end) if r.time_end != time() else \
+        datetime.combine(date.fromordinal(r.booked_date.toordinal() + 1), time())
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:reservation-{r.id}@vrra',
+        f'DTSTAMP:{r.booking_time.strftime(ICS_DATETIME)}',
+        f'DTSTART:{begin.strftime(ICS_DATETIME)}',
+        f'DTEND:{finish.strftime(ICS_DATETIME)}',
+        f'SUMMARY:{escape(r.subject)}',
+        f'LOCATION:Room {r.room_id}',
+        f'X-VRRA-ROOM:{r.room_id}',
+        f'X-VRRA-HOST:{r.username}',
+        ]
+    lines.extend(extra)
+    if r.message:
+        lines.append(f'DESCRIPTION:{escape(r.message)}')
+    if r.username in users:
+        lines.append(f'ORGANIZER;CN={quote(users[r.username][0])}:mailto:{users[r.username][1]}')
+    for username in party_usernames(r._party):
+        if username != r.username and username in users:
+            lines.append(f'ATTENDEE;CN={quote(users[username][0])}:mailto:{users[username][1]}')
+    lines.append('END:VEVENT')
+    return ''.join(fold(l) for l in lines)
+
+def export_ics(out, start=None, end=None, batch_size=5000):
+    users = load_users()
+    out.write(ICS_HEADER)
+    count = 0
+    for r in stream(export_query(start, end), batch_size):
+        out.write(vevent(r, users))
+        count += 1
+    out.write('END:VCALENDAR\r\n')
+    return count
@@ -0,0 +1,73 @@
+""" Daily room usage rollup (room_usage_daily), changed in the same transaction as every booking
+so analytics never read the reservation tables """
+from sqlalchemy import func
+
+from .cache import cache
+from .models import (
+    db, ArchivedParticipant, ArchivedReservation, Reservation, ReservationParticipant, RoomUsageDaily
+)
+from .occupancy import OPEN_MASK, hour_mask
+
+# bumped after every commit that changed the rollup
+USAGE_KEY = 'usage'
+
+
+def seat_hours(mask, attendees):
+    """ Seat-hours of a meeting taking the hours of mask with attendees, host included """
+    return bin(mask & OPEN_MASK).count('1') * attendees
+
+def usage_row(room_id, day):
+    return db.session.query(RoomUsageDaily).filter(
+        RoomUsageDaily.room_id==room_id, RoomUsageDaily.usage_date==day)
+
+def add_usage(room_id, day, mask, seats, meetings=1):
+    """ Adds meetings taking the hours of mask with seats seat-hours between them to a room-day,
+    caller commits """
+    db.insert_or_ignore(RoomUsageDaily.__table__, room_id=room_id, usage_date=day, hours=0, meetings=0, seat_hours=0)
+    usage_row(room_id, day).update({
+        RoomUsageDaily.hours: RoomUsageDaily.hours.op('|')(mask & OPEN_MASK),
+        RoomUsageDaily.meetings: RoomUsageDaily.meetings + meetings,
+        RoomUsageDaily.seat_hours: RoomUsageDaily.seat_hours + seats}, synchronize_session=False)
+
+def add_usage_days(room_id, days, mask, seats):
+    """ add_usage of one meeting on each of several days, caller commits """
+    db.insert_all_or_ignore(RoomUsageDaily.__table__,
+        [{'room_id': room_id, 'usage_date': d, 'hours': 0, 'meetings': 0, 'seat_hours': 0} for d in days])
+    db.session.query(RoomUsageDaily).filter(RoomUsageDaily.room_id==room_id, RoomUsageDaily.usage_date.in_(days)).update({
+        RoomUsageDaily.hours: RoomUsageDaily.hours.op('|')(mask & OPEN_MASK),
+        RoomUsageDaily.meetings: RoomUsageDaily.meetings + 1,
+        RoomUsageDaily.seat_hours: RoomUsageDaily.seat_hours + seats}, synchronize_session=False)
+
+def remove_usage(room_id, day, mask, seats, meetings=1):
+    """ Takes back what add_usage added for meetings that moved or were cancelled, caller commits """
+    usage_row(room_id, day).update({
+        RoomUsageDaily.hours: RoomUsageDaily.hours.op('&')(~mask),
+        RoomUsageDaily.meetings: RoomUsageDaily.meetings - meetings,
+        RoomUsageDaily.seat_hours: RoomUsageDaily.seat_hours - seats}, synchronize_session=False)
+
+def rebuild_usage():
+    """ Rebuilds the whole rollup from live and archived reservations, gets the number of room-days """
+    db.session.query(RoomUsageDaily).delete()
+
+    live = db.session.query(Reservation.room_id, Reservation.booked_date, Reservation.time_start,
+        Reservation.time_end, func.count(ReservationParticipant.username)).outerjoin(
+        ReservationParticipant, ReservationParticipant.reservation_id==Reservation.id).group_by(Reservation.id)
+    archived = db.session.query(ArchivedReservation.room_id, ArchivedReservation.booked_date, ArchivedReservation.time_start,
+        ArchivedReservation.time_end, func.count(ArchivedParticipant.username)).outerjoin(
+        ArchivedParticipant, ArchivedParticipant.archive_id==ArchivedReservation.archive_id).group_by(ArchivedReservation.archive_id)
+
+    usage = {}
+    for query in (live, archived):
+        for room_id, day, time_start, time_end, attendees in query:
+            mask = hour_mask(time_start, time_end) & OPEN_MASK
+            hours, meetings, seats = usage.get((room_id, day), (0, 0, 0))
+            usage[(room_id, day)] = (hours | mask, meetings + 1, seats + seat_hours(mask, attendees))
+
+    db.session.add_all(RoomUsageDaily(k[0], k[1], *v) for k, v in usage.items())
+    db.session.commit()
+    invalidate_usage()
+    return len(usage)
+
+def invalidate_usage():
+    """ Called after commits that changed the rollup, cached reports are computed again """
+    cache.bump(USAGE_KEY)
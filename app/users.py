@@ -0,0 +1,114 @@
+""" In-process caches of user rows and the participant directory """
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+from .cache import cache
+from .models import db, User
+
+# bumped by register/delete, shared between workers when the cache backend is
+USERS_KEY = 'users'
+
+
+def expired(loaded):
+    """ Without a shared cache backend other workers' invalidate_users() never reaches this one,
+    so rows and snapshots are only trusted for USER_CACHE_TTL seconds """
+    return time.monotonic() - loaded >= current_app.config['USER_CACHE_TTL']
+
+class UserCache(object):
+    """ Bounded LRU of detached User rows keyed by id as (user, load time), with a username index """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.by_id = OrderedDict()
+        self.by_username = {}
+        self.version = None
+        self.lock = threading.Lock()
+
+    def sync(self):
+        """ Drops everything when another request or worker changed users, or another app is asking """
+        version = users_version()
+        if version != self.version:
+            self.by_id.clear()
+            self.by_username.clear()
+            self.version = version
+
+    def store(self, user):
+        self.by_id[user.id] = (user, time.monotonic())
+        self.by_username[user.username] = user.id
+        while len(self.by_id) > self.max_entries:
+            _, (evicted, _) = self.by_id.popitem(last=False)
+            self.by_username.pop(evicted.username, None)
+
+    def drop(self, user_id):
+        entry = self.by_id.pop(user_id, None)
+        if entry is not None:
+            self.by_username.pop(entry[0].username, None)
+
+    def load(self, *criterion):
+        user = User.query.filter(*criterion).first()
+        if user is not None:
+            # detached so it can outlive the request's session
+            db.session.expunge(user)
+        return user
+
+    def get(self, user_id):
+        with self.lock:
+            self.sync()
+            entry = self.by_id.get(user_id)
+            if entry is not None and not expired(entry[1]):
+                self.by_id.move_to_end(user_id)
+                return entry[0]
+
+        user = self.load(User.id==user_id)
+        with self.lock:
+            if user is not None:
+                self.store(user)
+            else:
+                # deleted by a request another worker handled
+                self.drop(user_id)
+        return user
+
+    def get_by_username(self, username):
+        with self.lock:
+            self.sync()
+            user_id = self.by_username.get(username)
+        if user_id is not None:
+            return self.get(user_id)
+
+        user = self.load(User.username==username)
+        if user is not None:
+            with self.lock:
+                self.store(user)
+        return user
+
+class PartyDirectory(object):
+    """ Snapshot of every non-admin user as (username, name), with a username index """
+
+    def __init__(self, version, party):
+        self.version = version
+        self.loaded = time.monotonic()
+        self.party = party
+        self.index = {p[0]: p for p in party}
+
+user_cache = UserCache()
+_directory = None
+
+def get_directory():
+    """ Gets the participant directory, reloaded after users changed or USER_CACHE_TTL passed """
+    global _directory
+    version = users_version()
+    if _directory is None or _directory.version != version or expired(_directory.loaded):
+        party = [tuple(p) for p in db.session.query(User.username, User.name).filter(User.admin!=True).all()]
+        _directory = PartyDirectory(version, party)
+    return _directory
+
+def users_version():
+    """ Version of the users, with the current app's cache store so test apps don't share rows """
+    return cache.backend, cache.current(USERS_KEY)
+
+def invalidate_users():
+    """ Called after users are created or deleted """
+    cache.bump(USERS_KEY)
@@ -0,0 +1,214 @@
+""" Drives the hot endpoints through the Flask test client against seeded databases of
+several sizes and reports latency percentiles and SQL statements per request.
+
+    python benchmarks/endpoints.py --sizes 1000,10000 --iterations 50
+    python benchmarks/endpoints.py --baseline benchmarks/results/endpoints-abc1234.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SMTP_PORT = 2525
+
+statements = [0]
+
+
+def count_statement(*args):
+    statements[0] += 1
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def make_app(db_path):
+    """ An app against a scratch database with CSRF off and mail going to a local sink """
+    from app import create_app
+    from app.mail import use_debug_smtp
+
+    # a new app per size, cached status tables of the previous database can't leak into it
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_path, 'WTF_CSRF_ENABLED': False})
+    use_debug_smtp(app, SMTP_PORT)
+    return app
+
+def seed(app, size, users, days, rooms):
+    from app.models import db, Reservation
+    from app.seed import seed_database
+    from app.users import invalidate_users
+
+    with app.app_context():
+        db.create_all()
+        seed_database(users, size, days, rooms=rooms)
+        invalidate_users()
+        return db.session.query(Reservation).count()
+
+def timed(client, method, url, **kwargs):
+    """ Gets (seconds, statements, status code) of one request """
+    before = statements[0]
+    start = time.perf_counter()
+    response = getattr(client, method)(url, **kwargs)
+    return time.perf_counter() - start, statements[0] - before, response.status_code
+
+def book_form(i, usernames, days):
+    """ A free slot per iteration, past the seeded window: unique hour per day for the host """
+    return {
+        'subject': f'bench {i}',
+        'room_id': str(i % 5 + 1),
+        'booked_date': (date.today() + timedelta(days=days + 1 + i // 10)).isoformat(),
+        'time_start': str(8 + i % 10),
+        'time_end': str(9 + i % 10),
+        'party': [usernames[1 + i % (len(usernames) - 1)]],
+        'message': ''
+        }
+
+def run_size(size, args):
+    from app.mail import drain_outbox
+    from app.notify import flush_notifications
+    from app.models import db, Reservation, User
+
+    db_path = os.path.join(tempfile.mkdtemp(), f'bench-{size}.db')
+    app = make_app(db_path)
+    # enough days for the reservations to fit
+    days = max(args.days, size // 40)
+    count = seed(app, size, args.users, days, args.rooms)
+
+    with app.app_context():
+        usernames = [u for u, in db.session.query(User.username).filter(User.username.like('seed%')).order_by(User.username)]
+    client = app.test_client()
+    client.post('/auth/login', data={'username': usernames[0], 'password': 'password'})
+
+    rng = random.Random(0)
+    today = date.today()
+    samples = {}
+    def record(name, result):
+        samples.setdefault(name, []).append(result)
+
+    for i in range(args.iterations):
+        status_date = today + timedelta(days=rng.randrange(-days // 2, days // 2))
+        record('_get_status', timed(client, 'get', f'/_get_status?date={status_date.isoformat()}'))
+        record('status', timed(client, 'get', '/status'))
+        record('index', timed(client, 'get', '/index'))
+        record('profile', timed(client, 'get', '/profile'))
+
+        form = book_form(i, usernames, days)
+        record('book', timed(client, 'post', '/book', data=form))
+        with app.app_context():
+            id = db.session.query(Reservation.id).filter(Reservation.subject==form['subject']).scalar()
+        if id is None:
+            continue
+
+        form.update(subject=f'bench {i} edited', room_id=str((i + 1) % 5 + 1))
+        record('edit', timed(client, 'post', f'/{id}/edit', data=form))
+        record('cancel', timed(client, 'get', f'/{id}/cancel'))
+
+    # handlers only hold notifications, merge and deliver them to the sink outside the timings
+    with app.app_context():
+        changes, _ = flush_notifications(datetime.now() + timedelta(days=2))
+        sent = drain_outbox('bench', 500)
+
+    result = {'reservations': count, 'days': days, 'notifications': changes, 'mail_sent': sent, 'endpoints': {}}
+    for name, runs in samples.items():
+        latencies = np.array([r[0] for r in runs]) * 1000
+        queries = np.array([r[1] for r in runs])
+        codes = {}
+        for r in runs:
+            codes[str(r[2])] = codes.get(str(r[2]), 0) + 1
+        result['endpoints'][name] = {
+            'n': len(runs),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+            'p95_ms': round(float(np.percentile(latencies, 95)), 3),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+            'mean_queries': round(float(queries.mean()), 2),
+            'max_queries': int(queries.max()),
+            'status_codes': codes
+            }
+    return result
+
+def print_size(size, result):
+    print(f'\n{size} reservations requested, {result["reservations"]} seeded over {result["days"]} days, '
+          f'{result["notifications"]} meeting changes merged into {result["mail_sent"]} emails delivered to the sink')
+    print(f'  {"endpoint":<12} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"queries":>8}  status codes')
+    for name, r in result['endpoints'].items():
+        print(f'  {name:<12} {r["p50_ms"]:9.2f} {r["p95_ms"]:9.2f} {r["p99_ms"]:9.2f} {r["mean_queries"]:8.1f}  {r["status_codes"]}')
+
+def compare(results, baseline, factor):
+    """ Prints endpoints whose p95 grew by more than factor or that run more queries than
+    in a baseline run, gets their count """
+    regressions = 0
+    for size, result in results['sizes'].items():
+        before = baseline.get('sizes', {}).get(size)
+        if before is None:
+            continue
+        for name, r in result['endpoints'].items():
+            old = before['endpoints'].get(name)
+            if old is None:
+                continue
+            slower = r['p95_ms'] > old['p95_ms'] * factor
+            # cached responses make the mean wobble a little between runs
+            more_queries = r['mean_queries'] > old['mean_queries'] + 0.5
+            if slower or more_queries:
+                regressions += 1
+                print(f'  regression {size}/{name}: p95 {old["p95_ms"]:.2f} -> {r["p95_ms"]:.2f} ms, '
+                      f'queries {old["mean_queries"]} -> {r["mean_queries"]}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000', help='comma separated reservation counts')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--rooms', type=int, default=0, help='rooms seeded across sites on top of the default ones')
+    parser.add_argument('--days', type=int, default=60, help='least days the reservations spread over')
+    parser.add_argument('--iterations', type=int, default=50, help='requests per endpoint and size')
+    parser.add_argument('--output', help='results file [benchmarks/results/endpoints-<revision>.json]')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=1.5, help='p95 growth reported as a regression')
+    args = parser.parse_args()
+
+    from app.mail import DebugSMTPServer
+    sink = DebugSMTPServer(port=SMTP_PORT, echo=False).start()
+    event.listen(Engine, 'before_cursor_execute', count_statement)
+
+    rev = revision()
+    results = {
+        'revision': rev,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'iterations': args.iterations,
+        'sizes': {}
+        }
+    for size in (int(s) for s in args.sizes.split(',')):
+        results['sizes'][str(size)] = run_size(size, args)
+        print_size(size, results['sizes'][str(size)])
+    sink.shutdown()
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f'endpoints-{rev}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nResults written to {output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f'\nCompared with {baseline.get("revision", args.baseline)}:')
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+        print('  no regressions')
+
+if __name__ == '__main__':
+    main()
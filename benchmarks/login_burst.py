@@ -0,0 +1,105 @@
+""" Measures /_get_status latency while a burst of logins runs, with password hashing in the
+request threads against the bounded hashing pool.
+
+    python benchmarks/login_burst.py --logins 16 --seconds 10
+"""
+import argparse
+import itertools
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+
+# days ahead of today, shared by all readers so no date is ever read twice
+days = itertools.count()
+
+
+def make_app(db_path, mode, args):
+    """ A seeded app against a scratch database, hashing inline or in the pool """
+    from app import create_app
+    from app.hashing import hasher
+    from app.models import db
+    from app.seed import seed_database
+    from app.users import invalidate_users
+
+    hasher.shutdown()
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_path,
+        'WTF_CSRF_ENABLED': False,
+        'MAIL_SUPPRESS_SEND': True,
+        'PASSWORD_HASH_WORKERS': 0 if mode == 'inline' else args.workers,
+        'PASSWORD_HASH_QUEUE': args.queue})
+    with app.app_context():
+        db.create_all()
+        seed_database(args.users, args.reservations, 30)
+        invalidate_users()
+    return app
+
+def login(app, stopping, latencies, codes):
+    client = app.test_client()
+    while not stopping.is_set():
+        start = time.perf_counter()
+        response = client.post('/auth/login', data={'username': 'seed00000', 'password': 'password'})
+        latencies.append(time.perf_counter() - start)
+        codes[response.status_code] = codes.get(response.status_code, 0) + 1
+        client.get('/auth/logout')
+
+def status(app, stopping, latencies):
+    client = app.test_client()
+    while not stopping.is_set():
+        # a new date every time, the cached table would hide the cost
+        day = date.today() + timedelta(days=next(days))
+        start = time.perf_counter()
+        client.get(f'/_get_status?date={day.isoformat()}')
+        latencies.append(time.perf_counter() - start)
+
+def measure(app, logins, readers, seconds):
+    stopping = threading.Event()
+    login_latencies, status_latencies, codes = [], [], {}
+    threads = [threading.Thread(target=login, args=(app, stopping, login_latencies, codes)) for _ in range(logins)]
+    threads += [threading.Thread(target=status, args=(app, stopping, status_latencies)) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stopping.set()
+    for t in threads:
+        t.join()
+    return np.array(login_latencies) * 1000, np.array(status_latencies) * 1000, codes
+
+def report(label, logins, statuses, codes, seconds):
+    p = lambda a, q: float(np.percentile(a, q)) if len(a) else 0.0
+    print(f'  {label:<14} status p50 {p(statuses, 50):7.2f} ms  p95 {p(statuses, 95):7.2f} ms  '
+          f'{len(statuses) / seconds:6.0f}/s   login p50 {p(logins, 50):7.1f} ms  '
+          f'{len(logins) / seconds:5.1f}/s  {dict(sorted(codes.items()))}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--logins', type=int, default=16, help='threads logging in without pause')
+    parser.add_argument('--readers', type=int, default=2, help='threads reading /_get_status')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=2, help='hashing processes in pool mode')
+    parser.add_argument('--queue', type=int, default=16, help='PASSWORD_HASH_QUEUE in pool mode')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--reservations', type=int, default=2000)
+    parser.add_argument('--mode', choices=('inline', 'pool', 'both'), default='both')
+    args = parser.parse_args()
+
+    from app.hashing import hasher
+
+    print(f'{args.logins} login threads, {args.readers} status readers, {os.cpu_count()} cpus')
+    for mode in ('inline', 'pool') if args.mode == 'both' else (args.mode,):
+        app = make_app(os.path.join(tempfile.mkdtemp(), f'{mode}.db'), mode, args)
+        # warms up the pool's processes and the status queries
+        measure(app, 1, 1, 1)
+        report(f'{mode} idle', *measure(app, 0, args.readers, args.seconds), args.seconds)
+        report(f'{mode} burst', *measure(app, args.logins, args.readers, args.seconds), args.seconds)
+    hasher.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+""" Measures status reads while a writer keeps booking, with the old sqlite setup
+(rollback journal, a new connection per checkout) against the configured pool and pragmas.
+
+    python benchmarks/read_concurrency.py --readers 8 --seconds 10
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, time as hour, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
+
+BASELINE = {
+    'SQLALCHEMY_ENGINE_OPTIONS': {'poolclass': NullPool},
+    'SQLITE_PRAGMAS': {'journal_mode': 'DELETE'},
+    }
+
+
+def configure(app, db_path, mode):
+    from config import Config
+    from app.models import db
+
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + db_path,
+        SQLALCHEMY_ENGINE_OPTIONS=Config.SQLALCHEMY_ENGINE_OPTIONS,
+        SQLITE_PRAGMAS=Config.SQLITE_PRAGMAS)
+    if mode == 'baseline':
+        app.config.update(BASELINE)
+    # each mode gets its own file, so flask-sqlalchemy builds a new engine for it
+    with app.app_context():
+        db.create_all()
+
+def seed(app, days, per_day):
+    from app.models import db, Reservation, RoomOccupancy
+    from app.occupancy import hour_mask
+
+    with app.app_context():
+        today = date.today()
+        for d in range(days):
+            booked_date = today + timedelta(days=d)
+            for n in range(per_day):
+                room_id, ts = n % 5 + 1, 8 + n // 5
+                db.session.add(Reservation('bench', 'seed', room_id, datetime.now(), booked_date, hour(ts), hour(ts + 1), [], ''))
+            db.session.add_all(RoomOccupancy(room_id, booked_date, sum(
+                hour_mask(8 + n // 5, 9 + n // 5) for n in range(room_id - 1, per_day, 5))) for room_id in range(1, 6))
+        db.session.commit()
+
+def reader(app, days, stopping, latencies, errors):
+    from app.models import db, Reservation
+
+    rng = random.Random()
+    today = date.today()
+    while not stopping.is_set():
+        booked_date = today + timedelta(days=rng.randrange(days))
+        start = time.perf_counter()
+        try:
+            with app.app_context():
+                db.session.query(Reservation.room_id, Reservation.time_start, Reservation.time_end).filter(
+                    Reservation.booked_date==booked_date).all()
+        except OperationalError:
+            errors.append(1)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+def writer(app, days, stopping, commits, errors):
+    from app.models import db, Reservation
+
+    rng = random.Random(0)
+    today = date.today()
+    while not stopping.is_set():
+        booked_date = today + timedelta(days=days + rng.randrange(days))
+        try:
+            with app.app_context():
+                db.session.add(Reservation('bench', 'write', rng.randint(1, 5), datetime.now(), booked_date, hour(8), hour(9), [], ''))
+                db.session.commit()
+        except OperationalError:
+            errors.append(1)
+            continue
+        commits.append(1)
+
+def run(app, mode, args):
+    db_path = os.path.join(tempfile.mkdtemp(), f'{mode}.db')
+    configure(app, db_path, mode)
+    seed(app, args.days, args.per_day)
+
+    stopping = threading.Event()
+    latencies, commits, read_errors, write_errors = [], [], [], []
+    threads = [threading.Thread(target=reader, args=(app, args.days, stopping, latencies, read_errors))
+               for _ in range(args.readers)]
+    threads.append(threading.Thread(target=writer, args=(app, args.days, stopping, commits, write_errors)))
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stopping.set()
+    for t in threads:
+        t.join()
+
+    latencies.sort()
+    p = lambda q: latencies[min(int(len(latencies) * q), len(latencies) - 1)] * 1000 if latencies else 0
+    print(f'{mode:>8}: {len(latencies) / args.seconds:8.0f} reads/s  p50 {p(0.50):6.2f} ms  p95 {p(0.95):6.2f} ms  '
+          f'{len(commits) / args.seconds:6.0f} writes/s  {len(read_errors)} read / {len(write_errors)} write lock errors')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--days', type=int, default=30, help='days of seeded reservations')
+    parser.add_argument('--per-day', type=int, default=40)
+    parser.add_argument('--mode', choices=('baseline', 'tuned', 'both'), default='both')
+    args = parser.parse_args()
+
+    from app import create_app
+    app = create_app({'MAIL_SUPPRESS_SEND': True})
+    for mode in ('baseline', 'tuned') if args.mode == 'both' else (args.mode,):
+        run(app, mode, args)
+
+if __name__ == '__main__':
+    main()
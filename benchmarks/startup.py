@@ -0,0 +1,76 @@
+""" Measures cold start with python -X importtime: wall time of a fresh interpreter importing the
+package, building a web app and listing the CLI commands, and the modules costing the most.
+
+    python benchmarks/startup.py --runs 5
+    python benchmarks/startup.py --rev HEAD~1
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# trees from before create_app built their app on import
+BUILD = "import app; application = app.create_app() if hasattr(app, 'create_app') else app.app"
+SCENARIOS = {
+    'import': 'import app',
+    'web': BUILD,
+    'cli': BUILD + '; application.cli.list_commands(None)',
+    }
+
+
+def checkout(rev):
+    """ Extracts rev into a temporary directory, gets its path """
+    path = tempfile.mkdtemp(prefix='vrra-startup-')
+    archive = subprocess.run(['git', 'archive', rev], cwd=ROOT, check=True, capture_output=True).stdout
+    subprocess.run(['tar', '-x', '-C', path], input=archive, check=True)
+    return path
+
+def run(tree, statement):
+    """ One fresh interpreter running statement, gets (wall ms, {module: (self us, cumulative us)}) """
+    start = time.perf_counter()
+    done = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=tree,
+        capture_output=True, text=True)
+    wall = (time.perf_counter() - start) * 1000
+    if done.returncode:
+        sys.exit(done.stderr)
+
+    modules = {}
+    for line in done.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(own), int(cumulative))
+    return wall, modules
+
+def measure(tree, runs, top):
+    for scenario, statement in SCENARIOS.items():
+        results = [run(tree, statement) for _ in range(runs)]
+        walls = [wall for wall, _ in results]
+        modules = results[-1][1]
+        own = sum(v[0] for v in modules.values()) / 1000
+        print(f'  {scenario:<7} wall {statistics.median(walls):7.1f} ms (min {min(walls):6.1f})  '
+              f'imports {own:7.1f} ms  {len(modules):4d} modules')
+        heaviest = sorted(((v[1], name) for name, v in modules.items() if '.' not in name), reverse=True)[:top]
+        print('          ' + ', '.join(f'{name} {us / 1000:.1f}' for us, name in heaviest))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='interpreters per scenario, the median is shown')
+    parser.add_argument('--top', type=int, default=8, help='top-level packages shown by cumulative import ms')
+    parser.add_argument('--rev', help='also measure this git revision, e.g. the commit before a change')
+    args = parser.parse_args()
+
+    trees = [('working tree', ROOT)]
+    if args.rev:
+        trees.insert(0, (args.rev, checkout(args.rev)))
+    for label, tree in trees:
+        print(f'{label}:')
+        measure(tree, args.runs, args.top)
+
+if __name__ == '__main__':
+    main()
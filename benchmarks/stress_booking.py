@@ -0,0 +1,115 @@
+""" Fires concurrent bookings for the same room from several processes and checks
+that no two stored reservations overlap.
+
+    python benchmarks/stress_booking.py --processes 8 --attempts 50
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+from datetime import date, timedelta
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def make_app(db_path):
+    """ An app against a scratch database with mail and CSRF off """
+    from app import create_app
+    return create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_path,
+        'WTF_CSRF_ENABLED': False,
+        'MAIL_SUPPRESS_SEND': True,
+        # the workers are daemonic pool processes, hashing happens in them
+        'PASSWORD_HASH_WORKERS': 0})
+
+def setup(db_path, processes, rooms):
+    from werkzeug.security import generate_password_hash
+    from app.models import db, Room, User
+
+    app = make_app(db_path)
+    with app.app_context():
+        db.create_all()
+        db.session.add_all(Room(f'Room {i}') for i in range(1, rooms + 1))
+        password = generate_password_hash('stress')
+        db.session.add_all(User(f'stress{i}', f'Stress {i}', f'stress{i}@example.com', password) for i in range(processes))
+        db.session.commit()
+
+def worker(db_path, n, attempts, booked_date, rooms, start_barrier):
+    app = make_app(db_path)
+    client = app.test_client()
+    response = client.post('/auth/login', data={'username': f'stress{n}', 'password': 'stress'})
+    # a failed login would turn every booking into a redirect to the login page
+    assert response.status_code == 302 and urlparse(response.location).path != '/auth/login', \
+        f'stress{n} could not log in: {response.status_code}'
+
+    rng = random.Random(n)
+    start_barrier.wait()
+
+    outcomes = {'booked': 0, 'rejected': 0, 'failed': 0}
+    for _ in range(attempts):
+        ts = rng.randint(8, 21)
+        response = client.post('/book', data={
+            'subject': 'stress',
+            'room_id': str(rng.randint(1, rooms)),
+            'booked_date': booked_date.isoformat(),
+            'time_start': str(ts),
+            'time_end': str(ts + rng.randint(1, 3)),
+            'message': ''
+            })
+        # only the redirect to the index follows a stored reservation
+        if response.status_code == 302 and urlparse(response.location).path == '/index':
+            outcomes['booked'] += 1
+        elif response.status_code == 200:
+            outcomes['rejected'] += 1
+        else:
+            outcomes['failed'] += 1
+    return outcomes
+
+def find_overlaps(db_path):
+    from app.models import Reservation
+    from app.occupancy import hour_mask
+
+    app = make_app(db_path)
+    overlaps = []
+    with app.app_context():
+        taken = {}
+        for r in Reservation.query.order_by(Reservation.id).all():
+            key = (r.room_id, r.booked_date)
+            mask = hour_mask(r.time_start, r.time_end)
+            if taken.get(key, 0) & mask:
+                overlaps.append(r.id)
+            taken[key] = taken.get(key, 0) | mask
+    return overlaps
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--attempts', type=int, default=50, help='bookings tried per process')
+    parser.add_argument('--rooms', type=int, default=2, help='rooms the bookings compete for')
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'stress.db')
+    setup(db_path, args.processes, args.rooms)
+
+    booked_date = date.today() + timedelta(days=7)
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Manager() as manager:
+        barrier = manager.Barrier(args.processes)
+        with ctx.Pool(args.processes) as pool:
+            results = pool.starmap(worker, [
+                (db_path, n, args.attempts, booked_date, args.rooms, barrier) for n in range(args.processes)
+                ])
+
+    totals = {k: sum(r[k] for r in results) for k in results[0]}
+    overlaps = find_overlaps(db_path)
+    print(f'{totals["booked"]} booked, {totals["rejected"]} rejected, {totals["failed"]} failed, {len(overlaps)} overlapping')
+
+    if overlaps:
+        print(f'Overlapping reservation ids: {overlaps}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
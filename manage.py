@@ -1,7 +1,27 @@
 """ Handles CLI commands """
-from app.models import db, User
+from app.models import db, User, Reservation, ReservationParticipant, Room, RoomOccupancy, RoomUsageDaily
+from app.occupancy import rebuild_occupancy
+from app.rooms import ensure_rooms, invalidate_rooms, search_rooms
+from app.analytics import report_range, usage_report
+from app.archive import archive_expired, compact
+from app.seed import SEED_PASSWORD, seed_database
+from app.transfer import export_csv, export_ics, import_reservations
+from app.booking import update_records
+from app.metrics import metrics
+from app.hashing import hasher
+from app.mail import DebugSMTPServer, MailWorkerPool, drain_outbox, use_debug_smtp
+from app.notify import flush_notifications
+from app.scheduler import ReminderScheduler
+from app.usage import rebuild_usage
+from app.users import invalidate_users
+from config import OPEN_HOURS
+import json
+import time
+from datetime import date, datetime
 import click
+from flask import current_app
 from flask.cli import with_appcontext
+from sqlalchemy import event, inspect, text
 from werkzeug.security import generate_password_hash
 
 @click.command('drop-db')
@@ -20,8 +40,369 @@ def init_db_command():
         db.drop_all()
 
     db.create_all()
+    ensure_rooms()
     click.echo('Database initialized.')
     
+@click.command('build-occupancy')
+@with_appcontext
+def build_occupancy_command():
+    """Builds room occupancy index from existing reservations"""
+    # creates only the missing tables, existing data is kept
+    db.create_all()
+    count = rebuild_occupancy()
+    click.echo(f'Room occupancy index built ({count} room-days).')
+
+@click.command('build-usage')
+@with_appcontext
+def build_usage_command():
+    """Rebuilds the room usage rollup from live and archived reservations"""
+    db.create_all()
+    count = rebuild_usage()
+    click.echo(f'Room usage rollup built ({count} room-days).')
+
+@click.command('usage-report')
+@click.option('--start', help='First day, YYYY-MM-DD [ANALYTICS_DAYS before --end]')
+@click.option('--end', help='Last day, YYYY-MM-DD [today]')
+@click.option('--site', help='Only rooms of this site')
+@click.option('--top', default=10, help='Rooms listed, most utilized first')
+@click.option('--json', 'as_json', is_flag=True, help='Print the whole report as JSON')
+@with_appcontext
+def usage_report_command(start, end, site, top, as_json):
+    """Prints room utilization per weekday and hour, peak hours and the busiest rooms"""
+    try:
+        start, end = report_range(start, end)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+    started = time.perf_counter()
+    report = usage_report(start, end, site)
+    elapsed = (time.perf_counter() - started) * 1000
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+
+    click.echo(f'{report["start"]} - {report["end"]}{" at " + site if site else ""}: {report["meetings"]} meetings, '
+        f'{report["utilization"] * 100:.1f}% of open room hours booked')
+    click.echo('Peak hours: ' + (', '.join(f'{p["hour"]:02d}:00 ({p["utilization"] * 100:.0f}%)' for p in report['peak_hours']) or 'none'))
+    click.echo('\n% booked  ' + ''.join(f'{h:>4}' for h in report['hours']))
+    for day, row in zip(report['weekdays'], report['heatmap']):
+        click.echo(f'{day:<10}' + ''.join(f'{v * 100:4.0f}' for v in row))
+    click.echo(f'\n{"room":<24} {"site":<14} {"meetings":>8} {"hours":>6} {"used":>6} {"seats":>6}')
+    for r in report['rooms'][:top]:
+        seats = f'{r["seat_utilization"] * 100:5.1f}%' if r['seat_utilization'] is not None else ''
+        click.echo(f'{r["name"][:24]:<24} {(r["site"] or "")[:14]:<14} {r["meetings"]:>8} {r["booked_hours"]:>6} '
+            f'{r["utilization"] * 100:5.1f}% {seats:>6}')
+    click.echo(f'\nComputed in {elapsed:.1f} ms from the daily rollup.')
+
+@click.command('migrate-participants')
+@click.option('--batch-size', default=1000, help='Reservations backfilled per commit')
+@with_appcontext
+def migrate_participants_command(batch_size):
+    """Backfills participant table from reservations' party strings"""
+    db.create_all()
+    count = backfill_participants(batch_size)
+    click.echo(f'Participants backfilled for {count} reservations.')
+
+def backfill_participants(batch_size=1000):
+    """ Creates participant rows for reservations that have none yet """
+    count = 0
+    last_id = 0
+    while True:
+        batch = db.session.query(Reservation.id, Reservation.booked_date, Reservation._party).filter(
+            Reservation.id > last_id,
+            ~Reservation.participants.any()).order_by(Reservation.id).limit(batch_size).all()
+        if not batch:
+            return count
+
+        for r in batch:
+            # each entry is stored as 'username, name'
+            usernames = {p.split(',')[0].strip() for p in (r._party or '').split(';') if p}
+            db.session.add_all(ReservationParticipant(u, r.booked_date, r.id) for u in usernames)
+        db.session.commit()
+
+        count += len(batch)
+        last_id = batch[-1].id
+
+@click.command('migrate-db')
+@click.option('--explain/--no-explain', default=True, help='Report query plans of the hot queries before and after')
+@with_appcontext
+def migrate_db_command(explain):
+    """Brings an existing database up to the current schema, keeping its data"""
+    before = explain_hot_queries() if explain else {}
+
+    for change in migrate_schema():
+        click.echo(change)
+
+    click.echo(f'Participants backfilled for {backfill_participants()} reservations.')
+    click.echo(f'Rooms created for {ensure_rooms()} room ids.')
+    if not db.session.query(RoomOccupancy).first():
+        click.echo(f'Room occupancy index built ({rebuild_occupancy()} room-days).')
+    if not db.session.query(RoomUsageDaily).first():
+        click.echo(f'Room usage rollup built ({rebuild_usage()} room-days).')
+    click.echo('Database migrated.')
+
+    if explain:
+        after = explain_hot_queries()
+        for name in after:
+            click.echo(f'\n{name}')
+            click.echo('  before: ' + '; '.join(before.get(name) or ['n/a']))
+            click.echo('  after:  ' + '; '.join(after[name]))
+
+def migrate_schema():
+    """ Creates missing tables, columns and indexes in place, yields what was changed """
+    inspector = inspect(db.engine)
+    existing = set(inspector.get_table_names())
+
+    db.create_all()
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing:
+            yield f'Created table {table.name}.'
+            continue
+
+        columns = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            # sqlite can't add NOT NULL columns without a default, they're added nullable
+            preparer = db.engine.dialect.identifier_preparer
+            db.session.execute(text(f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN '
+                f'{preparer.format_column(column)} {column.type.compile(db.engine.dialect)}'))
+            yield f'Added column {table.name}.{column.name}.'
+
+        indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(db.engine)
+                yield f'Created index {index.name}.'
+
+    # reservations from before the scheduler count as last changed when booked
+    db.session.query(Reservation).filter(Reservation.updated_at==None).update(
+        {Reservation.updated_at: Reservation.booking_time}, synchronize_session=False)
+    # and from before calendar feeds as never changed
+    db.session.query(Reservation).filter(Reservation.version==None).update(
+        {Reservation.version: 0}, synchronize_session=False)
+    db.session.query(User).filter(User.calendar_version==None).update(
+        {User.calendar_version: 0}, synchronize_session=False)
+    db.session.query(User).filter(User.notify_digest==None).update(
+        {User.notify_digest: False}, synchronize_session=False)
+    db.session.commit()
+
+def hot_queries():
+    """ Queries run on every booking, listing and status request """
+    today = date.today()
+    return {
+        'status table': db.session.query(Reservation.room_id, Reservation.time_start, Reservation.time_end).filter(
+            Reservation.booked_date==today, Reservation.room_id.in_([1, 2])),
+        'room search': search_rooms('HQ', 8).with_entities(Room.id).order_by(Room.id).limit(21),
+        'room conflicts': db.session.query(RoomOccupancy.hours).filter(
+            RoomOccupancy.room_id==1, RoomOccupancy.booked_date==today),
+        'party conflicts': db.session.query(ReservationParticipant.username, Reservation.time_start, Reservation.time_end).join(
+            Reservation, Reservation.id==ReservationParticipant.reservation_id).filter(
+            ReservationParticipant.username.in_(['admin']), ReservationParticipant.booked_date==today),
+        'ongoing reservations': db.session.query(Reservation.id).filter(
+            Reservation.booked_date>=today, Reservation.status==0),
+        'profile': db.session.query(Reservation.id).filter(Reservation.username=='admin'),
+        'listing page': db.session.query(Reservation.id).filter(
+            Reservation.booked_date>=today).order_by(Reservation.booked_date, Reservation.time_start, Reservation.id).limit(51),
+        'reminder scheduler': db.session.query(Reservation.id, Reservation.booked_date, Reservation.updated_at).filter(
+            Reservation.reminder==False, Reservation.updated_at>=datetime.now()).order_by(Reservation.updated_at),
+    }
+
+def explain_hot_queries():
+    """ Gets SQLite's EXPLAIN QUERY PLAN lines per hot query, None where it can't run yet """
+    if db.engine.dialect.name != 'sqlite':
+        return {}
+
+    plans = {}
+    for name, query in hot_queries().items():
+        captured = []
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            captured.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            query.first()
+            statement, parameters = captured[-1]
+            plans[name] = [r[-1] for r in db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+        except Exception:
+            # tables or columns the query needs are not there before migrating
+            db.session.rollback()
+            plans[name] = None
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+    return plans
+
+@click.command('archive-reservations')
+@click.option('--older-than', type=click.IntRange(min=1), help='Archive reservations booked more than N days ago [ARCHIVE_AFTER_DAYS]')
+@click.option('--batch-size', default=500, help='Reservations moved per commit')
+@click.option('--full-vacuum', is_flag=True, help='Rewrite the database file instead of an incremental vacuum')
+@with_appcontext
+def archive_reservations_command(older_than, batch_size, full_vacuum):
+    """Moves expired reservations to the archive tables and compacts the database"""
+    if older_than is None:
+        older_than = current_app.config['ARCHIVE_AFTER_DAYS']
+    db.create_all()
+
+    count = 0
+    for moved in archive_expired(older_than, batch_size):
+        count += moved
+        click.echo(f'Archived {count} reservations...')
+    click.echo(f'Archived {count} reservations booked more than {older_than} days ago.')
+
+    released = compact(full_vacuum)
+    if released is None:
+        click.echo('Freed pages are kept for reuse, run with --full-vacuum to shrink the file.')
+    else:
+        click.echo(f'Released {released} pages.')
+
+@click.command('seed-db')
+@click.option('--users', default=50, help='Users to add')
+@click.option('--reservations', default=1000, help='Reservations to add among all seeded users')
+@click.option('--days', default=60, help='Days the reservations spread over, half of them in the past')
+@click.option('--seed', default=0, help='Random seed, the same seed gives the same data')
+@click.option('--rooms', default=0, help='Rooms to add across several sites')
+@with_appcontext
+def seed_db_command(users, reservations, days, seed, rooms):
+    """Bulk-generates synthetic rooms, users and reservations"""
+    db.create_all()
+    users, added = seed_database(users, reservations, days, seed, rooms)
+    invalidate_users()
+    click.echo(f'Seeded {users} users and {added} reservations (password "{SEED_PASSWORD}").')
+    if added < reservations:
+        click.echo(f'{reservations - added} reservations did not fit, use more --days.')
+
+def detect_format(fmt, filename):
+    if fmt:
+        return fmt
+    return 'ics' if filename.lower().endswith('.ics') else 'csv'
+
+@click.command('import-reservations')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ics']), help='Defaults to the file extension')
+@click.option('--rejects', type=click.Path(dir_okay=False), help='Rejected rows with reasons [SOURCE.rejects.csv]')
+@click.option('--batch-size', default=5000, help='Rows validated and inserted per commit')
+@with_appcontext
+def import_reservations_command(source, fmt, rejects, batch_size):
+    """Imports reservations from a CSV or iCalendar file, - reads stdin"""
+    fmt = detect_format(fmt, source.name)
+    rejects = rejects or ('rejects.csv' if source.name == '<stdin>' else source.name + '.rejects.csv')
+    db.create_all()
+
+    start = time.perf_counter()
+    with open(rejects, 'w', newline='', encoding='utf-8') as reject_file:
+        try:
+            stats = import_reservations(source, fmt, reject_file, batch_size)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    elapsed = time.perf_counter() - start
+
+    click.echo(f'Imported {stats.imported} reservations in {stats.batches} batches ({elapsed:.1f}s).')
+    if stats.rejected:
+        click.echo(f'Rejected {stats.rejected} rows, see {rejects}.')
+
+@click.command('export-reservations')
+@click.argument('target', type=click.File('w', encoding='utf-8', lazy=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ics']), help='Defaults to the file extension')
+@click.option('--start', type=click.DateTime(['%Y-%m-%d']), help='First booked date to export')
+@click.option('--end', type=click.DateTime(['%Y-%m-%d']), help='Last booked date to export')
+@click.option('--batch-size', default=5000, help='Rows read per query')
+@with_appcontext
+def export_reservations_command(target, fmt, start, end, batch_size):
+    """Exports reservations to a CSV or iCalendar file, - writes stdout"""
+    fmt = detect_format(fmt, target.name)
+    export = export_ics if fmt == 'ics' else export_csv
+    count = export(target, start and start.date(), end and end.date(), batch_size)
+    if target.name != '<stdout>':
+        click.echo(f'Exported {count} reservations to {target.name}.')
+
+@click.command('update-status')
+@with_appcontext
+def update_status_command():
+    """Syncs stored reservation statuses with current time"""
+    click.echo(f'Updated {update_records()} reservation statuses.')
+
+@click.command('mail-worker')
+@click.option('--workers', type=int, help='Number of worker threads [MAIL_WORKERS]')
+@click.option('--batch-size', type=int, help='Messages claimed per batch [MAIL_BATCH_SIZE]')
+@click.option('--once', is_flag=True, help='Drain the outbox once and exit')
+@click.option('--debug-smtp', type=int, metavar='PORT', help='Send to a local debugging SMTP server on PORT')
+@click.option('--metrics-port', type=int, help='Serve send latency and failure metrics on PORT')
+@with_appcontext
+def mail_worker_command(workers, batch_size, once, debug_smtp, metrics_port):
+    """Delivers queued emails from the outbox"""
+    app = current_app._get_current_object()
+    workers = workers or app.config['MAIL_WORKERS']
+    batch_size = batch_size or app.config['MAIL_BATCH_SIZE']
+
+    db.create_all()
+    if debug_smtp:
+        DebugSMTPServer(port=debug_smtp).start()
+        use_debug_smtp(app, debug_smtp)
+        click.echo(f'Debugging SMTP server listening on 127.0.0.1:{debug_smtp}.')
+
+    if once:
+        changes, messages = flush_notifications()
+        if changes:
+            click.echo(f'Merged {changes} meeting changes into {messages} emails.')
+        click.echo(f'Sent {drain_outbox("once", batch_size)} emails.')
+        return
+
+    if metrics_port:
+        metrics.serve(app, metrics_port)
+        click.echo(f'Metrics served on port {metrics_port}.')
+
+    pool = MailWorkerPool(app, workers, batch_size)
+    pool.start()
+    click.echo(f'Mail worker started with {workers} workers.')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pool.stop()
+        click.echo('Mail worker stopped.')
+
+@click.command('run-scheduler')
+@click.option('--poll-interval', type=float, help='Seconds between loads of new reservations [REMINDER_POLL_INTERVAL]')
+@click.option('--once', is_flag=True, help='Send reminders due now and exit')
+@with_appcontext
+def run_scheduler_command(poll_interval, once):
+    """Sends meeting reminders as they fall due"""
+    scheduler = ReminderScheduler(current_app.config['REMINDER_BATCH_SIZE'])
+
+    if once:
+        scheduler.load()
+        click.echo(f'Sent {scheduler.fire()} reminders.')
+        return
+
+    click.echo('Reminder scheduler started.')
+    try:
+        scheduler.run(poll_interval or current_app.config['REMINDER_POLL_INTERVAL'])
+    except KeyboardInterrupt:
+        click.echo('Reminder scheduler stopped.')
+
+@click.command('add-room')
+@click.argument('name')
+@click.option('--site', default='', help='Building or office the room is in')
+@click.option('--capacity', default=0, help='Seats')
+@click.option('--equipment', multiple=True, help='Equipment item, repeat for several')
+@click.option('--hours', default=f'{OPEN_HOURS[0]}-{OPEN_HOURS[1]}', help='Opening hours as OPEN-CLOSE, within OPEN_HOURS')
+@with_appcontext
+def add_room_command(name, site, capacity, equipment, hours):
+    """Adds a bookable room"""
+    try:
+        open_hour, close_hour = (int(h) for h in hours.split('-'))
+    except ValueError:
+        raise click.BadParameter('expected OPEN-CLOSE, e.g. 8-18', param_hint='--hours')
+    if not OPEN_HOURS[0] <= open_hour < close_hour <= OPEN_HOURS[1]:
+        raise click.BadParameter(f'must lie within {OPEN_HOURS[0]}-{OPEN_HOURS[1]}', param_hint='--hours')
+
+    db.create_all()
+    room = Room(name, site, capacity, open_hour, close_hour, equipment)
+    db.session.add(room)
+    db.session.commit()
+    invalidate_rooms()
+    click.echo(f'Added room {room.id} ({name}).')
+
 @click.command('create-admin')
 @with_appcontext
 def create_admin_command():
@@ -38,11 +419,25 @@ def create_admin_command():
             admin_email = d[d.find('=')+1:-1].strip(" \'")
 
     # note: USERNAME is actually EMAIL
-    db.session.add(User('admin','Admin', admin_email, generate_password_hash('admin'), admin=True))
+    db.session.add(User('admin','Admin', admin_email, generate_password_hash('admin', hasher.method), admin=True))
     db.session.commit()
+    invalidate_users()
     click.echo('Created admin account.')
 
 def init_app(app):
     app.cli.add_command(init_db_command)
     app.cli.add_command(drop_db_command)
-    app.cli.add_command(create_admin_command)
\ No newline at end of file
+    app.cli.add_command(create_admin_command)
+    app.cli.add_command(add_room_command)
+    app.cli.add_command(build_occupancy_command)
+    app.cli.add_command(build_usage_command)
+    app.cli.add_command(usage_report_command)
+    app.cli.add_command(migrate_participants_command)
+    app.cli.add_command(migrate_db_command)
+    app.cli.add_command(update_status_command)
+    app.cli.add_command(archive_reservations_command)
+    app.cli.add_command(seed_db_command)
+    app.cli.add_command(import_reservations_command)
+    app.cli.add_command(export_reservations_command)
+    app.cli.add_command(mail_worker_command)
+    app.cli.add_command(run_scheduler_command)
\ No newline at end of file